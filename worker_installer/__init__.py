@@ -15,20 +15,59 @@
 
 
 import os
+import copy
+import time
+import threading
+from collections import OrderedDict
 from functools import wraps
 import json
 
 from cloudify import context
 from cloudify.exceptions import NonRecoverableError
 
-from worker_installer.utils import (FabricRunner,
+from worker_installer.utils import (ParamikoRunner,
+                                    create_runner,
                                     is_on_management_worker)
+from worker_installer.timing import report_timings
+from worker_installer import agent_package
 
 DEFAULT_MIN_WORKERS = 2
 DEFAULT_MAX_WORKERS = 5
 DEFAULT_REMOTE_EXECUTION_PORT = 22
 DEFAULT_WAIT_STARTED_TIMEOUT = 15
 DEFAULT_WAIT_STARTED_INTERVAL = 1
+DEFAULT_PACKAGE_CACHE_DIR = '/var/cache/cloudify-agent'
+DEFAULT_PACKAGE_CACHE_SIZE = 512 * 1024 * 1024
+STATIC_AUTOSCALE = 'static'
+AUTO_AUTOSCALE = 'auto'
+# with autoscale: auto, the most worker processes per cpu and the memory
+# each worker process is expected to take, in megabytes
+DEFAULT_WORKERS_PER_CPU = 2
+DEFAULT_WORKER_MEMORY = 256
+
+# the settings of the cloudify_agent performance section
+CELERY_POOLS = ['prefork', 'eventlet', 'gevent']
+PERFORMANCE_PARAMS = ['prefetch_multiplier', 'pool', 'max_tasks_per_child',
+                      'broker_heartbeat', 'acks_late']
+# celery 4 settings the agents' celery 3.1 workers would fail to start with
+UNSUPPORTED_PERFORMANCE_PARAMS = {
+    'max_memory_per_child': 'max_tasks_per_child'
+}
+
+# runtime property holding the worker bounds computed with autoscale: auto
+AUTOSCALE_PROPERTY = 'cloudify_agent_autoscale'
+
+# runtime property holding the host facts of a node instance, bump
+# HOST_FACTS_VERSION whenever the stored facts change
+HOST_FACTS_PROPERTY = 'cloudify_agent_host_facts'
+HOST_FACTS_VERSION = 3
+# only the facts operations read back from the runtime property, the
+# others are probed along with the facts which change with every operation
+STORED_HOST_FACTS = ['distro', 'home_dir']
+# directory under base_dir where an installation records its checkpoints
+INSTALL_CHECKPOINTS_DIR = '.install-checkpoints'
+DEFAULT_CONFIGURATION_CACHE_TTL = 300
+DEFAULT_CONFIGURATION_CACHE_SIZE = 1000
 
 
 def _find_type_in_kwargs(cls, all_args):
@@ -51,43 +90,55 @@ def init_worker_installer(func):
             raise NonRecoverableError(
                 'CloudifyContext not found in invocation args')
 
-        if 'cloudify_agent' in kwargs:
-            if ctx.type == context.NODE_INSTANCE and \
-                    ctx.node.properties.get('cloudify_agent'):
-                raise NonRecoverableError("'cloudify_agent' is configured "
-                                          "both as a node property and as an "
-                                          "invocation input parameter for "
-                                          "operation '{0}'"
-                                          .format(ctx.operation.name))
-            agent_config = kwargs['cloudify_agent']
-        else:
-            if ctx.type == context.NODE_INSTANCE and \
-                    ctx.node.properties.get('cloudify_agent'):
-                agent_config = ctx.node.properties['cloudify_agent']
-            else:
-                agent_config = {}
-        prepare_connection_configuration(ctx, agent_config)
-        runner = FabricRunner(ctx, agent_config)
+        agent_config = get_agent_configuration(ctx, kwargs)
+        runner = create_runner(ctx, agent_config)
         try:
-            prepare_additional_configuration(ctx, agent_config, runner)
+            _prepare_host_configuration(ctx, agent_config, runner)
+            _set_distro(ctx, runner, agent_config)
 
             kwargs['runner'] = runner
             kwargs['agent_config'] = agent_config
 
-            if not (agent_config.get('distro') and
-                    agent_config.get('distro_codename')):
-                distro_info = get_machine_distro(runner)
-                if not agent_config.get('distro'):
-                    agent_config['distro'] = distro_info[0]
-                if not agent_config.get('distro_codename'):
-                    agent_config['distro_codename'] = distro_info[2]
             return func(*args, **kwargs)
         finally:
-            # Fixes CFY-1741 (clear fabric connection cache)
+            # returns the connection to the pool, idle connections are
+            # evicted there (CFY-1741)
             runner.close()
+            try:
+                report_timings(ctx, runner.timer, func.__name__)
+            except Exception as e:
+                # must not replace the operation's own error
+                ctx.logger.debug('Failed reporting timings: {0}'
+                                 .format(str(e)))
     return wrapper
 
 
+def get_agent_configuration(ctx, kwargs):
+    """returns an operation's agent configuration, resolved as far as it
+    can be without connecting to the agent's host
+
+    The configuration is taken from the operation's cloudify_agent input
+    or from the node's cloudify_agent property.
+    """
+    if 'cloudify_agent' in kwargs:
+        if ctx.type == context.NODE_INSTANCE and \
+                ctx.node.properties.get('cloudify_agent'):
+            raise NonRecoverableError("'cloudify_agent' is configured "
+                                      "both as a node property and as an "
+                                      "invocation input parameter for "
+                                      "operation '{0}'"
+                                      .format(ctx.operation.name))
+        agent_config = kwargs['cloudify_agent']
+    else:
+        if ctx.type == context.NODE_INSTANCE and \
+                ctx.node.properties.get('cloudify_agent'):
+            agent_config = ctx.node.properties['cloudify_agent']
+        else:
+            agent_config = {}
+    configuration_cache.resolve(ctx, agent_config)
+    return agent_config
+
+
 def get_machine_distro(runner):
     """retrieves the distribution information of the machine"""
 
@@ -97,6 +148,110 @@ def get_machine_distro(runner):
     return json.loads(stdout)
 
 
+def get_host_facts(runner, agent_config):
+    """retrieves the facts about the host the installer needs
+
+    All facts are gathered by a single remote command and cached on the
+    runner, so they describe the host as it was when first asked for.
+    """
+    facts = getattr(runner, 'host_facts', None)
+    if facts is None:
+        with runner.timer.phase('facts'):
+            stdout = _run_py_cmd_with_output(
+                runner,
+                'import json, multiprocessing, os, platform, pwd, '
+                'subprocess; from distutils.spawn import find_executable',
+                _host_facts_command(agent_config))
+        facts = json.loads(stdout)
+        runner.host_facts = facts
+        if isinstance(runner, ParamikoRunner) and not facts['sudo']:
+            runner.ctx.logger.warning(
+                'The paramiko runner cannot answer sudo password prompts '
+                'and {0} has no passwordless sudo for {1}, use the fabric '
+                'runner instead'.format(agent_config.get('host'),
+                                        agent_config.get('user')))
+    return facts
+
+
+def _host_facts_command(agent_config):
+    if 'home_dir' in agent_config:
+        home_dir = repr(str(agent_config['home_dir']))
+    else:
+        home_dir = 'pwd.getpwnam({0!r}).pw_dir'.format(
+            str(agent_config['user']))
+    # base_dir is relative to home_dir, which may only be known remotely
+    paths = agent_paths('', str(agent_config['name']))
+    # a single expression, as expected by _run_py_cmd_with_output
+    return ("(lambda home_dir, sudo_list: json.dumps({{"
+            "'distro': platform.dist(), "
+            "'home_dir': home_dir, "
+            "'base_dir_exists': os.path.exists(home_dir + {0!r}), "
+            "'init_file_exists': os.path.exists({1!r}), "
+            "'config_file_exists': os.path.exists({2!r}), "
+            "'install_checkpoints': (lambda d: sorted(os.listdir(d)) "
+            "if os.path.isdir(d) else None)("
+            "home_dir + {0!r} + '/' + {4!r}), "
+            "'wget': find_executable('wget') is not None, "
+            "'curl': find_executable('curl') is not None, "
+            "'pigz': find_executable('pigz') is not None, "
+            "'zstd': find_executable('zstd') is not None, "
+            "'cpu_count': multiprocessing.cpu_count(), "
+            "'memory_available': (lambda meminfo: "
+            "int(meminfo['MemAvailable']) * 1024 "
+            "if 'MemAvailable' in meminfo else "
+            "os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES'))("
+            "dict((l.split()[0].rstrip(':'), l.split()[1]) "
+            "for l in open('/proc/meminfo')) "
+            "if os.path.exists('/proc/meminfo') else {{}}), "
+            "'sudo': sudo_list[1] == 0, "
+            "'requiretty': 'requiretty' in "
+            "sudo_list[0].replace('!requiretty', '')}}))"
+            "({3}, (lambda p: (p.communicate()[0], p.returncode))("
+            "subprocess.Popen('sudo -n -l', shell=True, "
+            "stdout=subprocess.PIPE, stderr=subprocess.STDOUT)))"
+            .format(paths['base_dir'],
+                    paths['init_file'],
+                    paths['config_file'],
+                    home_dir,
+                    INSTALL_CHECKPOINTS_DIR))
+
+
+def get_stored_host_facts(ctx, runner, agent_config):
+    """retrieves the host facts which do not change for a node instance
+
+    The facts are stored in the instance's runtime properties, stamped
+    with the facts version, host and user they were gathered for. They
+    are gathered again when the stamp does not match or when
+    'refresh_host_facts' is set in the agent configuration.
+    """
+    stamp = {
+        'version': HOST_FACTS_VERSION,
+        'host': agent_config.get('host'),
+        'user': agent_config.get('user')
+    }
+    on_instance = ctx.type == context.NODE_INSTANCE
+    if on_instance and \
+            not _get_bool(agent_config, 'refresh_host_facts', False):
+        stored = ctx.instance.runtime_properties.get(HOST_FACTS_PROPERTY)
+        if stored and stored.get('stamp') == stamp:
+            return stored
+    facts = get_host_facts(runner, agent_config)
+    stored = dict((key, facts[key]) for key in STORED_HOST_FACTS)
+    stored['stamp'] = stamp
+    if on_instance:
+        ctx.instance.runtime_properties[HOST_FACTS_PROPERTY] = stored
+    return stored
+
+
+def _set_distro(ctx, runner, config):
+    if not (config.get('distro') and config.get('distro_codename')):
+        distro_info = get_stored_host_facts(ctx, runner, config)['distro']
+        if not config.get('distro'):
+            config['distro'] = distro_info[0]
+        if not config.get('distro_codename'):
+            config['distro_codename'] = distro_info[2]
+
+
 def _run_py_cmd_with_output(runner, imports_line, command):
     """
     To overcome the situation where additional info is printed
@@ -105,6 +260,13 @@ def _run_py_cmd_with_output(runner, imports_line, command):
     and the following closing brackets to retrieve the original output.
     """
 
+    if runner.local:
+        # no need for another interpreter, the command is evaluated by
+        # this one
+        namespace = {}
+        exec imports_line in namespace
+        return eval(command, namespace)
+
     delim_start = '###CLOUDIFYDISTROOPEN'
     delim_end = 'CLOUDIFYDISTROCLOSE###'
 
@@ -160,6 +322,93 @@ def _prepare_and_validate_autoscale_params(ctx, config):
     config['min_workers'] = min_workers
     config['max_workers'] = max_workers
 
+    autoscale = config.get('autoscale', STATIC_AUTOSCALE)
+    if autoscale not in [STATIC_AUTOSCALE, AUTO_AUTOSCALE]:
+        raise NonRecoverableError(
+            'autoscale should be one of {0}, {1} but is: {2}'
+            .format(STATIC_AUTOSCALE, AUTO_AUTOSCALE, autoscale))
+    config['autoscale'] = autoscale
+    for key, default in [('workers_per_cpu', DEFAULT_WORKERS_PER_CPU),
+                         ('worker_memory', DEFAULT_WORKER_MEMORY)]:
+        value = config.get(key, default)
+        if not str(value).isdigit() or int(value) == 0:
+            raise NonRecoverableError('{0} is supposed to be a positive '
+                                      'number but is: {1}'.format(key, value))
+        config[key] = int(value)
+
+
+def _prepare_and_validate_performance_params(config):
+    performance = config.get('performance') or {}
+    if not isinstance(performance, dict):
+        raise NonRecoverableError('performance is supposed to be a dict '
+                                  'but is: {0}'.format(performance))
+    for key, alternative in sorted(UNSUPPORTED_PERFORMANCE_PARAMS.items()):
+        if key in performance:
+            raise NonRecoverableError(
+                '{0} is not supported by the agent\'s celery 3.1 worker, '
+                'use {1} instead'.format(key, alternative))
+    unknown = sorted(set(performance) - set(PERFORMANCE_PARAMS))
+    if unknown:
+        raise NonRecoverableError(
+            'Unknown performance settings: {0}, expected some of {1}'
+            .format(', '.join(unknown), ', '.join(PERFORMANCE_PARAMS)))
+    validated = dict((key, None) for key in PERFORMANCE_PARAMS)
+    for key, minimum in [('prefetch_multiplier', 0),
+                         ('broker_heartbeat', 0),
+                         ('max_tasks_per_child', 1)]:
+        if performance.get(key) is None:
+            continue
+        value = performance[key]
+        if not str(value).isdigit() or int(value) < minimum:
+            raise NonRecoverableError(
+                '{0} is supposed to be a number of at least {1} but is: '
+                '{2}'.format(key, minimum, value))
+        validated[key] = int(value)
+    pool = performance.get('pool')
+    if pool is not None and pool not in CELERY_POOLS:
+        raise NonRecoverableError('pool should be one of {0} but is: {1}'
+                                  .format(', '.join(CELERY_POOLS), pool))
+    validated['pool'] = pool
+    if performance.get('acks_late') is not None:
+        validated['acks_late'] = _get_bool(performance, 'acks_late', None)
+    config['performance'] = validated
+
+
+def set_autoscale_from_host(ctx, runner, agent_config):
+    """computes the worker bounds from the host's capacity
+
+    Only with autoscale: auto, in which case min_workers and max_workers
+    are replaced: at most workers_per_cpu workers per cpu, as long as
+    each can have worker_memory megabytes of the memory available, and
+    at least one worker per cpu within that. The bounds and what they
+    were computed from are stored in the node instance's runtime
+    properties.
+    """
+    if agent_config['autoscale'] != AUTO_AUTOSCALE:
+        return
+    facts = get_host_facts(runner, agent_config)
+    cpu_count = facts['cpu_count']
+    memory_available = facts['memory_available']
+    by_memory = memory_available // (agent_config['worker_memory'] *
+                                     1024 * 1024)
+    max_workers = max(1, min(cpu_count * agent_config['workers_per_cpu'],
+                             by_memory))
+    min_workers = min(cpu_count, max_workers)
+    agent_config['min_workers'] = min_workers
+    agent_config['max_workers'] = max_workers
+    autoscale = {
+        'min_workers': min_workers,
+        'max_workers': max_workers,
+        'cpu_count': cpu_count,
+        'memory_available': memory_available,
+        'workers_per_cpu': agent_config['workers_per_cpu'],
+        'worker_memory': agent_config['worker_memory']
+    }
+    ctx.logger.info('Computed the worker bounds of cloudify agent {0}: '
+                    '{1}'.format(agent_config['name'], autoscale))
+    if ctx.type == context.NODE_INSTANCE:
+        ctx.instance.runtime_properties[AUTOSCALE_PROPERTY] = autoscale
+
 
 def _set_auth(ctx, config):
     is_password = config.get('password')
@@ -207,14 +456,34 @@ def _set_wait_started_config(config):
         config['wait_started_interval'] = DEFAULT_WAIT_STARTED_INTERVAL
 
 
-def _set_home_dir(runner, config):
+def _set_home_dir(ctx, runner, config):
     if 'home_dir' not in config:
-        home_dir = _run_py_cmd_with_output(
-            runner,
-            'import pwd',
-            'pwd.getpwnam(\'{0}\').pw_dir'.format(config['user']))
-
-        config['home_dir'] = home_dir
+        config['home_dir'] = str(
+            get_stored_host_facts(ctx, runner, config)['home_dir'])
+
+
+def _set_package_cache_config(config):
+    config['package_cache'] = _get_bool(config, 'package_cache', False)
+    if 'package_cache_dir' not in config:
+        config['package_cache_dir'] = DEFAULT_PACKAGE_CACHE_DIR
+    package_cache_size = config.get('package_cache_size',
+                                    DEFAULT_PACKAGE_CACHE_SIZE)
+    if not str(package_cache_size).isdigit():
+        raise NonRecoverableError('package_cache_size is supposed to be a '
+                                  'number but is: {0}'
+                                  .format(package_cache_size))
+    config['package_cache_size'] = int(package_cache_size)
+
+
+def _set_agent_package_compression(config):
+    compression = config.get('agent_package_compression',
+                             agent_package.GZIP)
+    if compression not in agent_package.PACKAGE_COMPRESSIONS:
+        raise NonRecoverableError(
+            'agent_package_compression should be one of {0} but is: {1}'
+            .format(', '.join(sorted(agent_package.PACKAGE_COMPRESSIONS)),
+                    compression))
+    config['agent_package_compression'] = compression
 
 
 def _get_bool(config, key, default):
@@ -248,29 +517,41 @@ def prepare_connection_configuration(ctx, agent_config):
         agent_config['name'] = name
     else:
         agent_config['host'] = get_machine_ip(ctx)
-        _set_auth(ctx, agent_config)
-        _set_user(ctx, agent_config)
-        _set_remote_execution_port(ctx, agent_config)
         agent_config['name'] = ctx.instance.id
+        _set_remote_connection(ctx, agent_config)
+
+
+def prepare_host_connection_configuration(ctx, agent_config):
+    """prepares the connection configuration for an explicitly given host
+
+    Unlike prepare_connection_configuration, the host and the agent name
+    are taken from the agent configuration and not from the context.
+    """
+    for key in ['host', 'name']:
+        if not agent_config.get(key):
+            raise NonRecoverableError(
+                'Missing {0} in worker configuration '
+                '[cloudify_agent={1}'.format(key, agent_config))
+    _set_remote_connection(ctx, agent_config)
+
+
+def _set_remote_connection(ctx, agent_config):
+    _set_auth(ctx, agent_config)
+    _set_user(ctx, agent_config)
+    _set_remote_execution_port(ctx, agent_config)
 
 
 def prepare_additional_configuration(ctx, agent_config, runner):
 
-    _set_wait_started_config(agent_config)
+    prepare_settings_configuration(ctx, agent_config)
+    _prepare_host_configuration(ctx, agent_config, runner)
 
-    _set_home_dir(runner, agent_config)
 
-    home_dir = agent_config['home_dir']
-    agent_config['celery_base_dir'] = home_dir
+def prepare_settings_configuration(ctx, agent_config):
+    """validates the agent settings which depend on neither the host nor
+    the runner, completing them with their defaults"""
 
-    agent_config['base_dir'] = '{0}/cloudify.{1}'.format(
-        home_dir, agent_config['name'])
-    agent_config['init_file'] = '/etc/init.d/celeryd-{0}'.format(
-        agent_config['name'])
-    agent_config['config_file'] = '/etc/default/celeryd-{0}'.format(
-        agent_config['name'])
-    agent_config['includes_file'] = '{0}/work/celeryd-includes'.format(
-        agent_config['base_dir'])
+    _set_wait_started_config(agent_config)
 
     agent_config['disable_requiretty'] = _get_bool(agent_config,
                                                    'disable_requiretty',
@@ -278,4 +559,117 @@ def prepare_additional_configuration(ctx, agent_config, runner):
     agent_config['delete_amqp_queues'] = _get_bool(agent_config,
                                                    'delete_amqp_queues',
                                                    True)
+    agent_config['stream_agent_package'] = _get_bool(agent_config,
+                                                     'stream_agent_package',
+                                                     False)
+    agent_config['relocate_agent_package'] = _get_bool(
+        agent_config, 'relocate_agent_package', False)
+    _set_agent_package_compression(agent_config)
+    _set_package_cache_config(agent_config)
     _prepare_and_validate_autoscale_params(ctx, agent_config)
+    _prepare_and_validate_performance_params(agent_config)
+
+
+def _prepare_host_configuration(ctx, agent_config, runner):
+
+    _set_home_dir(ctx, runner, agent_config)
+
+    home_dir = agent_config['home_dir']
+    agent_config['celery_base_dir'] = home_dir
+    agent_config.update(agent_paths(home_dir, agent_config['name']))
+
+
+def agent_paths(home_dir, name):
+    """returns the paths of an agent's files on its host"""
+    base_dir = '{0}/cloudify.{1}'.format(home_dir, name)
+    return {
+        'base_dir': base_dir,
+        'init_file': '/etc/init.d/celeryd-{0}'.format(name),
+        'config_file': '/etc/default/celeryd-{0}'.format(name),
+        'includes_file': '{0}/work/celeryd-includes'.format(base_dir)
+    }
+
+
+def prepare_runner_configuration(ctx, agent_config, runner):
+    """completes the agent configuration using the host behind the runner"""
+
+    prepare_additional_configuration(ctx, agent_config, runner)
+    _set_distro(ctx, runner, agent_config)
+
+
+class ConfigurationCache(object):
+    """
+    A process wide cache of resolved agent configurations.
+
+    Resolving an agent configuration checks the ssh key file and fills in
+    defaults from the manager's bootstrap context. The connection
+    configuration and the settings are resolved at most once every
+    ``ttl`` seconds per node instance (or deployment), raw configuration
+    and the bootstrap context values they depend on, and later operations
+    get a copy of the result. The bootstrap context is still read once per
+    operation (a REST call) to tell whether it changed.
+    The parts depending on the host are left for the runner to complete.
+    Expired entries are dropped as new ones are added, and at most
+    ``max_size`` entries are kept, the oldest being dropped first.
+    """
+
+    def __init__(self, ttl=DEFAULT_CONFIGURATION_CACHE_TTL,
+                 max_size=DEFAULT_CONFIGURATION_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # configuration key -> (expiry, resolved configuration), by expiry
+        self._configurations = OrderedDict()
+
+    def resolve(self, ctx, agent_config):
+        """resolves agent_config in place, as
+        prepare_connection_configuration and prepare_settings_configuration
+        would"""
+        key = _configuration_key(ctx, agent_config)
+        with self._lock:
+            entry = self._configurations.get(key)
+        if entry and time.time() < entry[0]:
+            agent_config.update(copy.deepcopy(entry[1]))
+            return
+
+        prepare_connection_configuration(ctx, agent_config)
+        prepare_settings_configuration(ctx, agent_config)
+        now = time.time()
+        with self._lock:
+            self._configurations.pop(key, None)
+            # all entries live as long, the first to expire come first
+            while self._configurations:
+                oldest = next(iter(self._configurations))
+                if len(self._configurations) < self.max_size and \
+                        self._configurations[oldest][0] > now:
+                    break
+                del self._configurations[oldest]
+            self._configurations[key] = (now + self.ttl,
+                                         copy.deepcopy(agent_config))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._configurations)
+
+    def clear(self):
+        with self._lock:
+            self._configurations = OrderedDict()
+
+
+def _configuration_key(ctx, agent_config):
+    # everything the resolved configuration depends on, besides the key file
+    if is_on_management_worker(ctx):
+        target = (None, os.environ.get('MANAGEMENT_USER'))
+    else:
+        target = (ctx.instance.id, get_machine_ip(ctx))
+    bootstrap_agent = ctx.bootstrap_context.cloudify_agent
+    bootstrap = (bootstrap_agent.user,
+                 bootstrap_agent.agent_key_path,
+                 bootstrap_agent.remote_execution_port,
+                 bootstrap_agent.min_workers,
+                 bootstrap_agent.max_workers)
+    return (ctx.type, ctx.deployment.id) + target + bootstrap + (
+        json.dumps(agent_config, sort_keys=True, default=repr),)
+
+
+configuration_cache = ConfigurationCache()
@@ -0,0 +1,188 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import os
+import gzip
+import tarfile
+from StringIO import StringIO
+
+from worker_installer.utils import BatchCommand
+from worker_installer.utils import symlink_command
+
+# the package's members are extracted with --strip=2
+STRIP_COMPONENTS = 2
+VIRTUALENV_LINKS = ['archives', 'bin', 'include', 'lib']
+# compressing fast matters more than compressing well, the package is
+# compressed while it is streamed
+RELOCATED_COMPRESS_LEVEL = 1
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+# compression -> (agent resource, package extension)
+PACKAGE_COMPRESSIONS = {
+    GZIP: ('agent_package_path', 'tar.gz'),
+    ZSTD: ('agent_package_zstd_path', 'tar.zst')
+}
+
+
+def extract_command(package_file, base_dir, compression, host_facts):
+    """returns a shell command extracting an agent package into base_dir
+
+    ``package_file`` may be - to read the package from stdin. A gzipped
+    package is decompressed by pigz if the host has it. The extracted
+    files are not listed, there is no use in sending their names back.
+    """
+    if compression == ZSTD:
+        decompress = '--use-compress-program=zstd'
+    elif host_facts.get('pigz'):
+        decompress = '--use-compress-program=pigz'
+    else:
+        decompress = '-z'
+    return 'tar {0} -xf {1} --strip={2} -C {3}'.format(
+        decompress, package_file, STRIP_COMPONENTS, base_dir)
+
+
+def virtualenv_link_commands(base_dir, ignore_errors=False, phase=None):
+    """returns the BatchCommands pointing the virtualenv's links at
+    base_dir"""
+    return [symlink_command(link_path, target,
+                            ignore_errors=ignore_errors, phase=phase)
+            for link_path, target in _virtualenv_links(base_dir)]
+
+
+def shebang_command(base_dir, phase=None):
+    """returns a BatchCommand pointing the virtualenv's scripts at its
+    python"""
+    return BatchCommand(
+        "sed -i '1 s|.*/bin/python.*$|{0}|g' {1}/env/bin/*".format(
+            _shebang(base_dir), base_dir),
+        phase=phase,
+        native=lambda: _fix_shebangs(base_dir))
+
+
+def relocate_package_chunks(chunks, base_dir):
+    """relocates an agent package to base_dir as it is read
+
+    Reads a gzipped agent package from ``chunks`` and yields it back,
+    compressed again, with the virtualenv's links and script shebangs
+    already pointing at base_dir, so that nothing needs fixing once it
+    is extracted. The package is never held in memory as a whole, only
+    the scripts being rewritten are.
+    """
+    links = dict(_virtualenv_links(base_dir))
+    shebang = _shebang(base_dir)
+    source = tarfile.open(fileobj=_ChunksFile(chunks), mode='r|gz')
+    buf = _DrainableBuffer()
+    compressed = gzip.GzipFile(fileobj=buf, mode='wb',
+                               compresslevel=RELOCATED_COMPRESS_LEVEL)
+    target = tarfile.open(fileobj=compressed, mode='w|')
+    try:
+        for member in source:
+            path = '{0}/{1}'.format(base_dir, _strip(member.name))
+            fileobj = None
+            if member.issym() and path in links:
+                member.linkname = links[path]
+            elif member.isfile():
+                fileobj = source.extractfile(member)
+                if path.startswith('{0}/env/bin/'.format(base_dir)):
+                    content = _replace_shebang(fileobj.read(), shebang)
+                    member.size = len(content)
+                    fileobj = StringIO(content)
+            target.addfile(member, fileobj)
+            data = buf.drain()
+            if data:
+                yield data
+        target.close()
+        compressed.close()
+        data = buf.drain()
+        if data:
+            yield data
+    finally:
+        source.close()
+
+
+def _virtualenv_links(base_dir):
+    return [('{0}/env/local/{1}'.format(base_dir, link),
+             '{0}/env/{1}'.format(base_dir, link))
+            for link in VIRTUALENV_LINKS]
+
+
+def _shebang(base_dir):
+    return '#!{0}/env/bin/python'.format(base_dir)
+
+
+def _fix_shebangs(base_dir):
+    # unlike sed -i, links and files needing no change are left untouched
+    shebang = _shebang(base_dir)
+    bin_dir = '{0}/env/bin'.format(base_dir)
+    for name in os.listdir(bin_dir):
+        path = os.path.join(bin_dir, name)
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            first_line = f.readline()
+            if '/bin/python' not in first_line:
+                continue
+            content = first_line + f.read()
+        with open(path, 'wb') as f:
+            f.write(_replace_shebang(content, shebang))
+
+
+def _strip(name):
+    return '/'.join(name.split('/')[STRIP_COMPONENTS:])
+
+
+def _replace_shebang(content, shebang):
+    # same as shebang_command's sed expression
+    first_line, newline, rest = content.partition('\n')
+    if '/bin/python' not in first_line:
+        return content
+    return shebang + newline + rest
+
+
+class _ChunksFile(object):
+    """a read only file object over an iterable of chunks"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+
+class _DrainableBuffer(object):
+    """a write only file object whose content is taken as it is written"""
+
+    def __init__(self):
+        self._data = []
+
+    def write(self, data):
+        self._data.append(data)
+
+    def drain(self):
+        data = ''.join(self._data)
+        self._data = []
+        return data
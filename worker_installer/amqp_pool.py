@@ -0,0 +1,144 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import time
+import threading
+from contextlib import contextmanager
+
+from pika.exceptions import AMQPConnectionError
+from pika.exceptions import ChannelClosed
+
+from cloudify import amqp_client
+
+DEFAULT_AMQP_IDLE_TIMEOUT = 300
+# errors of a connection the broker closed while it was idle in the pool
+STALE_CONNECTION_ERRORS = (AMQPConnectionError, ChannelClosed)
+
+
+class AMQPChannelPool(object):
+    """
+    Keeps a broker connection and channel open across installations.
+
+    The connection is created lazily on first use and shared by all users
+    in the process, one at a time as pika connections are not thread safe.
+    It is replaced before use if it has been idle for longer than
+    ``idle_timeout`` seconds or if either it or the channel were closed,
+    and dropped if an error occurs while it is in use.
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_AMQP_IDLE_TIMEOUT,
+                 create_client=None):
+        self.idle_timeout = idle_timeout
+        self._create_client = create_client or amqp_client.create_client
+        self._lock = threading.RLock()
+        self._client = None
+        self._channel = None
+        self._last_used = None
+
+    @contextmanager
+    def channel(self):
+        with self._lock:
+            if self._client is not None and not self._is_healthy():
+                self.close()
+            if self._client is None:
+                self._client = self._create_client()
+            if self._channel is None:
+                self._channel = self._client.connection.channel()
+            try:
+                yield self._channel
+            except Exception:
+                self.close()
+                raise
+            self._last_used = time.time()
+
+    def call(self, func):
+        """calls func with the pooled channel and returns its result
+
+        The broker may have closed a pooled connection, on a missed
+        heartbeat for instance, while its flags still say it is open. If
+        func fails on a reused connection with a connection or channel
+        error, it is called once more on a fresh connection.
+        """
+        with self._lock:
+            reused = self._client is not None and self._is_healthy()
+            try:
+                with self.channel() as channel:
+                    return func(channel)
+            except STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+            with self.channel() as channel:
+                return func(channel)
+
+    def close(self):
+        with self._lock:
+            client = self._client
+            self._client = None
+            self._channel = None
+            self._last_used = None
+            if client is not None:
+                try:
+                    client.close()
+                except Exception:
+                    pass
+
+    def reset(self):
+        """
+        Drops the broker connection and channel without closing them.
+
+        Called in a forked bulk worker process. Closing the inherited pika
+        connection would send connection.close over the parent's socket
+        and end the parent's session with the broker, so the child leaves
+        it alone and opens a connection of its own on first use.
+        """
+        # a parent thread inside channel() while forking keeps the copied
+        # lock held forever in the child
+        self._lock = threading.RLock()
+        self._client = None
+        self._channel = None
+        self._last_used = None
+
+    def _is_healthy(self):
+        if self._last_used is not None and \
+                time.time() - self._last_used > self.idle_timeout:
+            return False
+        if not self._client.connection.is_open:
+            return False
+        return self._channel is None or self._channel.is_open
+
+
+amqp_channel_pool = AMQPChannelPool()
+
+
+def worker_queues(worker_name):
+    """returns the names of the queues a celery worker consumes from"""
+    return [
+        # celery worker queue
+        worker_name,
+        # celery management queue
+        'celery@{0}.celery.pidbox'.format(worker_name)
+    ]
+
+
+def delete_worker_queues(worker_names, pool=None):
+    """deletes the queues of many celery workers over a single channel"""
+    pool = pool or amqp_channel_pool
+
+    def delete_queues(channel):
+        for worker_name in worker_names:
+            for queue in worker_queues(worker_name):
+                channel.queue_delete(queue)
+    pool.call(delete_queues)
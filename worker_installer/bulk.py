@@ -0,0 +1,220 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import time
+import multiprocessing
+
+from cloudify.exceptions import NonRecoverableError
+
+from worker_installer import prepare_host_connection_configuration
+from worker_installer import prepare_runner_configuration
+from worker_installer import tasks
+from worker_installer.utils import create_runner
+from worker_installer.utils import connection_pool
+from worker_installer.amqp_pool import amqp_channel_pool
+
+DEFAULT_CONCURRENCY = 10
+
+# the invoking context, set in each of the pool's processes
+_ctx = None
+
+
+def install_many(ctx, agent_configs, concurrency=DEFAULT_CONCURRENCY,
+                 start=True):
+    """installs and starts agents on many hosts at once
+
+    Each agent configuration describes a single host and must contain
+    the host's address ('host') and the agent's name ('name'), the rest
+    is completed the same way it is for the install operation.
+
+    Hosts are handled by a pool of at most ``concurrency`` processes (the
+    same approach fabric takes for parallel execution), so fabric's global
+    state and ssh connections are never shared between hosts.
+
+    Returns a result dict per agent configuration, in the given order,
+    with the agent's name and host, whether the installation succeeded,
+    the error if it did not, its duration in seconds and, if it
+    succeeded, its timing summary (see worker_installer.timing).
+    """
+    return _run_many(ctx, agent_configs, concurrency,
+                     _install_and_start, start, 'install')
+
+
+def uninstall_many(ctx, agent_configs, concurrency=DEFAULT_CONCURRENCY,
+                   stop=True):
+    """stops and uninstalls agents on many hosts at once
+
+    Agent configurations, concurrency and results are the same as for
+    install_many. Each host is cleaned up by a single remote invocation.
+    """
+    return _run_many(ctx, agent_configs, concurrency,
+                     _stop_and_uninstall, stop, 'uninstall')
+
+
+def status_many(ctx, agent_configs, concurrency=DEFAULT_CONCURRENCY,
+                timeout=tasks.DEFAULT_PING_TIMEOUT):
+    """checks whether the agents on many hosts are alive
+
+    The workers of all the agents are pinged with a single broadcast,
+    waiting at most ``timeout`` seconds for their replies. Only the hosts
+    of the agents which did not reply are asked over ssh whether the
+    agent's service runs, the same way uninstall_many handles hosts.
+
+    Returns a result dict per agent configuration, in the given order,
+    as install_many does. Results also tell whether the agent is alive
+    and whether it was checked by the 'broker' or over 'ssh'.
+    """
+    if not agent_configs:
+        return []
+    worker_names = [tasks.celery_worker_name(config['name'])
+                    for config in agent_configs if config.get('name')]
+    try:
+        replied = tasks.ping_workers(worker_names, timeout)
+    except Exception as e:
+        ctx.logger.debug('Failed pinging cloudify agents, checking all of '
+                         'them over ssh [error={0}]'.format(str(e)))
+        replied = set()
+
+    results = [None] * len(agent_configs)
+    unanswered = []
+    for index, config in enumerate(agent_configs):
+        if not config.get('name') or \
+                tasks.celery_worker_name(config['name']) not in replied:
+            unanswered.append(index)
+            continue
+        results[index] = {
+            'name': config['name'],
+            'host': config.get('host'),
+            'success': True,
+            'error': None,
+            'timings': None,
+            'duration': 0,
+            'checked_by': 'broker'
+        }
+    checked = _run_many(ctx, [agent_configs[index] for index in unanswered],
+                        concurrency, _check_status, None, 'status check')
+    for index, result in zip(unanswered, checked):
+        result['checked_by'] = 'ssh'
+        results[index] = result
+    for result in results:
+        result['alive'] = result['success']
+    return results
+
+
+def _run_many(ctx, agent_configs, concurrency, func, flag, action):
+    if not agent_configs:
+        return []
+    processes = max(1, min(int(concurrency), len(agent_configs)))
+    ctx.logger.info('Running {0} of {1} cloudify agents [concurrency={2}]'
+                    .format(action, len(agent_configs), processes))
+
+    pool = multiprocessing.Pool(processes=processes,
+                                initializer=_init_process,
+                                initargs=(ctx,))
+    try:
+        results = pool.map(_run_host,
+                           [(func, config, flag)
+                            for config in agent_configs],
+                           chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    for result in results:
+        if result['success']:
+            ctx.logger.debug('Finished {0} of cloudify agent {1} on {2} '
+                             '[duration={3:.2f}s]'
+                             .format(action, result['name'], result['host'],
+                                     result['duration']))
+        else:
+            ctx.logger.error('Failed {0} of cloudify agent {1} on {2}: '
+                             '{3}'.format(action, result['name'],
+                                          result['host'], result['error']))
+    return results
+
+
+def _init_process(ctx):
+    global _ctx
+    _ctx = ctx
+    # connections inherited from the parent process belong to it
+    connection_pool.reset()
+    amqp_channel_pool.reset()
+
+
+def _run_host(args):
+    func, agent_config, flag = args
+    result = {
+        'name': agent_config.get('name'),
+        'host': agent_config.get('host'),
+        'success': True,
+        'error': None,
+        'timings': None
+    }
+    started = time.time()
+    try:
+        result['timings'] = func(_ctx, agent_config, flag)
+    except Exception as e:
+        result['success'] = False
+        result['error'] = str(e)
+    result['duration'] = time.time() - started
+    return result
+
+
+def _prepare_host(ctx, agent_config):
+    prepare_host_connection_configuration(ctx, agent_config)
+    runner = create_runner(ctx, agent_config, local=False)
+    try:
+        prepare_runner_configuration(ctx, agent_config, runner)
+    except Exception:
+        runner.close()
+        raise
+    return runner
+
+
+def _install_and_start(ctx, agent_config, start):
+    runner = _prepare_host(ctx, agent_config)
+    try:
+        tasks.install_agent(ctx, runner, agent_config)
+        if start:
+            tasks.start_agent(runner, agent_config)
+    finally:
+        runner.close()
+    return runner.timer.summary()
+
+
+def _stop_and_uninstall(ctx, agent_config, stop):
+    runner = _prepare_host(ctx, agent_config)
+    try:
+        if stop:
+            tasks.stop_agent(ctx, runner, agent_config)
+        tasks.uninstall_agent(ctx, runner, agent_config)
+    finally:
+        runner.close()
+    return runner.timer.summary()
+
+
+def _check_status(ctx, agent_config, flag):
+    # the host's facts are not needed, only a connection to it
+    prepare_host_connection_configuration(ctx, agent_config)
+    runner = create_runner(ctx, agent_config, local=False)
+    try:
+        if not tasks.agent_service_running(runner, agent_config):
+            raise NonRecoverableError(
+                'cloudify agent {0} is not running'.format(
+                    agent_config['name']))
+    finally:
+        runner.close()
+    return runner.timer.summary()
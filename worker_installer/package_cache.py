@@ -0,0 +1,188 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import re
+import hashlib
+import threading
+import urllib2
+import uuid
+
+from cloudify.exceptions import HttpException
+
+from worker_installer.utils import DEFAULT_HTTP_TIMEOUT
+from worker_installer.utils import read_resource_chunks
+from worker_installer.utils import download_resource_command
+
+# the extensions of the packages kept in the cache, the first is the
+# default
+PACKAGE_EXTENSIONS = ['tar.gz', 'tar.zst']
+
+# packages are stored writable by all, so that agents of other users
+# can mark them as used
+CACHE_DIR_MODE = 0777
+PACKAGE_MODE = 0666
+
+# a package's checksum may be published next to it, in sha256sum's format
+CHECKSUM_SUFFIX = '.sha256'
+MAX_CHECKSUM_FILE_SIZE = 4096
+
+# url -> (validators, checksum)
+_checksums = {}
+_checksums_lock = threading.Lock()
+
+
+def get_package_checksum(url):
+    """returns the sha256 checksum of a package on the file server
+
+    The checksum published next to the package (see CHECKSUM_SUFFIX) is
+    used if there is one. Otherwise the package is read once per process
+    and url, later calls only issue a HEAD request to verify the package
+    did not change since, which is assumed if the file server tells
+    nothing about it.
+    """
+    checksum = _get_published_checksum(url)
+    if checksum:
+        return checksum
+    validators = _get_validators(url)
+    with _checksums_lock:
+        cached = _checksums.get(url)
+    if cached and cached[0] == validators:
+        return cached[1]
+    checksum = hashlib.sha256()
+    for chunk in read_resource_chunks(url):
+        checksum.update(chunk)
+    checksum = checksum.hexdigest()
+    with _checksums_lock:
+        _checksums[url] = (validators, checksum)
+    return checksum
+
+
+def _get_published_checksum(url):
+    try:
+        response = urllib2.urlopen(url + CHECKSUM_SUFFIX,
+                                   timeout=DEFAULT_HTTP_TIMEOUT)
+    except urllib2.URLError:
+        # HTTPError included, most likely nothing was published
+        return None
+    try:
+        content = response.read(MAX_CHECKSUM_FILE_SIZE)
+    finally:
+        response.close()
+    fields = content.split()
+    if fields and re.match('^[0-9a-f]{64}$', fields[0].lower()):
+        return fields[0].lower()
+    return None
+
+
+def _get_validators(url):
+    request = urllib2.Request(url)
+    request.get_method = lambda: 'HEAD'
+    try:
+        response = urllib2.urlopen(request, timeout=DEFAULT_HTTP_TIMEOUT)
+    except urllib2.HTTPError as e:
+        raise HttpException(e.url, e.code, e.msg)
+    try:
+        headers = response.info()
+        validators = (headers.getheader('etag'),
+                      headers.getheader('last-modified'),
+                      headers.getheader('content-length'))
+    finally:
+        response.close()
+    if not any(validators):
+        return None
+    return validators
+
+
+def cached_package_path(cache_dir, checksum,
+                        extension=PACKAGE_EXTENSIONS[0]):
+    return '{0}/{1}.{2}'.format(cache_dir, checksum, extension)
+
+
+def prepare_cache_dir_command(cache_dir):
+    """returns a shell command making sure the cache directory exists
+
+    The cache is shared by the agents of all users on the host, each may
+    store, replace and evict packages, so the directory is writable by
+    all of them.
+    """
+    return ('{{ [ -d {0} ] || sudo mkdir -p {0}; }} && '
+            '{{ [ -w {0} ] || sudo chmod {1:o} {0}; }}'
+            .format(cache_dir, CACHE_DIR_MODE))
+
+
+def verify_command(file_path, checksum):
+    return 'echo "{0}  {1}" | sha256sum -c - > /dev/null'.format(
+        checksum, file_path)
+
+
+def temp_path(file_path):
+    return '{0}.{1}.part'.format(file_path, uuid.uuid4().hex)
+
+
+def cache_hit_command(cache_dir, checksum, extension=PACKAGE_EXTENSIONS[0]):
+    """returns a shell command which fails unless a package is cached"""
+    cached = cached_package_path(cache_dir, checksum, extension)
+    return '[ -f {0} ] && {1} && touch {0}'.format(
+        cached, verify_command(cached, checksum))
+
+
+def store_command(cache_dir, checksum, extension=PACKAGE_EXTENSIONS[0]):
+    """returns a shell command storing a package read from stdin"""
+    cached = cached_package_path(cache_dir, checksum, extension)
+    part = temp_path(cached)
+    return ('{{ cat > {0} && {1} && chmod {2:o} {0} && mv {0} {3}; }} || '
+            '{{ rm -f {0}; false; }}'
+            .format(part, verify_command(part, checksum), PACKAGE_MODE,
+                    cached))
+
+
+def fetch_command(url, cache_dir, checksum,
+                  extension=PACKAGE_EXTENSIONS[0], host_facts=None):
+    """returns a shell command making sure a package is in the cache
+
+    The package is downloaded only if it is missing from the cache or if
+    the cached copy does not match its checksum. The host's facts, if
+    given, choose the download tool.
+    """
+    cached = cached_package_path(cache_dir, checksum, extension)
+    part = temp_path(cached)
+    return ('if [ -f {0} ] && {1}; then touch {0}; else '
+            '{{ {2} && {3} && chmod {4:o} {5} && mv {5} {0}; }} || '
+            '{{ rm -f {5}; false; }}; fi'
+            .format(cached,
+                    verify_command(cached, checksum),
+                    download_resource_command(url, part, host_facts),
+                    verify_command(part, checksum),
+                    PACKAGE_MODE,
+                    part))
+
+
+def evict_command(cache_dir, max_size, keep):
+    """returns a shell command evicting least recently used packages
+
+    Packages are removed, oldest access first, until the cache takes no
+    more than ``max_size`` bytes. ``keep`` is never removed.
+    """
+    packages = ' '.join('{0}/*.{1}'.format(cache_dir, extension)
+                        for extension in PACKAGE_EXTENSIONS)
+    return ('total=0; '
+            'for f in $(ls -tr {0} 2>/dev/null); do '
+            'total=$((total + $(wc -c < $f))); done; '
+            'for f in $(ls -tr {0} 2>/dev/null); do '
+            '[ $total -le {1} ] && break; '
+            '[ "$f" = "{2}" ] && continue; '
+            'size=$(wc -c < $f); rm -f $f; total=$((total - size)); '
+            'done'.format(packages, max_size, keep))
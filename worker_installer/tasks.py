@@ -16,9 +16,13 @@
 
 import time
 import os
+import math
+import socket
+import hashlib
+import threading
 import jinja2
+from celery.events import EventReceiver
 
-from cloudify import amqp_client
 from cloudify import ctx
 from cloudify.decorators import operation
 from cloudify.exceptions import NonRecoverableError
@@ -27,8 +31,22 @@ from cloudify import manager
 from cloudify import utils
 
 from worker_installer import init_worker_installer
+from worker_installer import get_agent_configuration
+from worker_installer import get_host_facts
+from worker_installer import set_autoscale_from_host
+from worker_installer import INSTALL_CHECKPOINTS_DIR
+from worker_installer import package_cache
+from worker_installer import agent_package
+from worker_installer.amqp_pool import delete_worker_queues
 from worker_installer.utils import is_on_management_worker
-from worker_installer.utils import download_resource_on_host
+from worker_installer.utils import create_runner
+from worker_installer.utils import download_resource_command
+from worker_installer.utils import BatchCommand
+from worker_installer.utils import mkdir_command
+from worker_installer.utils import touch_command
+from worker_installer.utils import remove_command
+from worker_installer.utils import FabricRunnerException
+from worker_installer.utils import read_resource_chunks
 
 
 PLUGIN_INSTALLER_PLUGIN_PATH = 'plugin_installer.tasks'
@@ -50,10 +68,28 @@ DEFAULT_AGENT_RESOURCES = {
     '/packages/templates/{0}-celeryd-cloudify.init.template',
     'agent_package_path':
     '/packages/agents/{0}-{1}-agent.tar.gz',
+    'agent_package_zstd_path':
+    '/packages/agents/{0}-{1}-agent.tar.zst',
     'disable_requiretty_script_path':
     '/packages/scripts/{0}-agent-disable-requiretty.sh'
 }
 
+AGENT_PACKAGE_RESOURCES = [
+    resource for resource, _ in agent_package.PACKAGE_COMPRESSIONS.values()]
+
+# the checkpoints an installation records in INSTALL_CHECKPOINTS_DIR, a
+# retry resumes after the last one
+PACKAGE_CHECKPOINT = 'package'
+CONFIGURATION_CHECKPOINT = 'configuration'
+INSTALLED_CHECKPOINT = 'installed'
+
+DEFAULT_TEMPLATE_CACHE_TTL = 300
+MAX_WAIT_STARTED_INTERVAL = 5
+# seconds to wait for the workers to reply to a ping
+DEFAULT_PING_TIMEOUT = 1
+# exit code of a delete command whose path does not exist
+MISSING_PATH_CODE = 100
+
 
 def get_agent_resource_url(ctx, agent_config, resource):
     """returns an agent's resource url
@@ -68,7 +104,7 @@ def get_agent_resource_url(ctx, agent_config, resource):
         resource_path = DEFAULT_AGENT_RESOURCES.get(resource)
         if not resource_path:
             raise NonRecoverableError('no such resource: {0}'.format(resource))
-        if resource == 'agent_package_path':
+        if resource in AGENT_PACKAGE_RESOURCES:
             origin = utils.get_manager_file_server_url() + \
                 resource_path.format(agent_config['distro'],
                                      agent_config['distro_codename'])
@@ -91,7 +127,7 @@ def get_agent_resource_local_path(ctx, agent_config, resource):
         resource_path = DEFAULT_AGENT_RESOURCES.get(resource)
         if not resource_path:
             raise NonRecoverableError('no such resource: {0}'.format(resource))
-        if resource == 'agent_package_path':
+        if resource in AGENT_PACKAGE_RESOURCES:
             origin = resource_path.format(agent_config['distro'],
                                           agent_config['distro_codename'])
         else:
@@ -100,6 +136,51 @@ def get_agent_resource_local_path(ctx, agent_config, resource):
     return origin
 
 
+class TemplateCache(object):
+    """
+    A process wide cache of compiled jinja2 templates.
+
+    A template's source is fetched with its resource loader at most once
+    every ``ttl`` seconds. When the ttl expires the source is fetched
+    again, and the template is only recompiled if the source changed.
+    """
+
+    def __init__(self, ttl=DEFAULT_TEMPLATE_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (resource loader, template path) -> (expiry, checksum, template)
+        self._templates = {}
+
+    def get_template(self, resource_loader, template_path):
+        key = (resource_loader, template_path)
+        with self._lock:
+            entry = self._templates.get(key)
+        if entry and time.time() < entry[0]:
+            return entry[2]
+
+        source = resource_loader(template_path)
+        if source is None:
+            raise jinja2.TemplateNotFound(template_path)
+        checksum = hashlib.sha256(source).hexdigest()
+        if entry and entry[1] == checksum:
+            template = entry[2]
+        else:
+            env = jinja2.Environment(
+                loader=jinja2.FunctionLoader(resource_loader))
+            template = env.from_string(source)
+        with self._lock:
+            self._templates[key] = (time.time() + self.ttl, checksum,
+                                    template)
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._templates = {}
+
+
+template_cache = TemplateCache()
+
+
 def get_celery_includes_list():
     return CELERY_INCLUDES_LIST
 
@@ -107,12 +188,10 @@ def get_celery_includes_list():
 @operation
 @init_worker_installer
 def install(ctx, runner, agent_config, **kwargs):
-    agent_package_url = get_agent_resource_url(
-        ctx, agent_config, 'agent_package_path')
+    install_agent(ctx, runner, agent_config)
 
-    ctx.logger.debug("Pinging agent installer target")
-    runner.ping()
 
+def install_agent(ctx, runner, agent_config):
     ctx.logger.info(
         'Installing cloudify agent {0}. '
         'Connection details --> {1}'
@@ -130,42 +209,39 @@ def install(ctx, runner, agent_config, **kwargs):
 
     ctx.logger.debug(
         'Installing celery worker [cloudify_agent={0}]'.format(agent_config))
-    runner.run('mkdir -p {0}'.format(agent_config['base_dir']))
-
-    ctx.logger.debug(
-        'Downloading agent package from: {0}'.format(agent_package_url))
-    download_resource_on_host(
-        ctx.logger, runner, agent_package_url, '{0}/{1}'.format(
-            agent_config['base_dir'], 'agent.tar.gz'))
-
-    ctx.logger.debug('extracting agent package on host')
-    runner.run(
-        'tar xzvf {0}/agent.tar.gz --strip=2 -C {1}'.format(
-            agent_config['base_dir'], agent_config['base_dir']))
-
-    ctx.logger.debug('configuring virtualenv')
-    for link in ['archives', 'bin', 'include', 'lib']:
-        link_path = '{0}/env/local/{1}'.format(agent_config['base_dir'], link)
-        try:
-            runner.run('unlink {0}'.format(link_path))
-            runner.run('ln -s {0}/env/{1} {2}'.format(
-                agent_config['base_dir'], link, link_path))
-
-        except Exception as e:
-            ctx.logger.warn('Error processing link: {0} [error={1}] - '
-                            'ignoring..'.format(link_path, str(e)))
-
-    create_celery_configuration(
-        ctx, runner, agent_config, manager.get_resource)
-
-    runner.run('sudo chmod +x {0}'.format(agent_config['init_file']))
-
-    # This is for fixing virtualenv included in package paths
-    runner.run("sed -i '1 s|.*/bin/python.*$|#!{0}/env/bin/python|g' "
-               "{0}/env/bin/*".format(agent_config['base_dir']))
-
-    # Remove downloaded agent package
-    runner.run('rm {0}/agent.tar.gz'.format(agent_config['base_dir']))
+    base_dir = agent_config['base_dir']
+    checkpoints = _install_checkpoints(runner, agent_config) or []
+    if checkpoints:
+        ctx.logger.info('Resuming the installation of cloudify agent {0}, '
+                        'completed: {1}'.format(agent_config['name'],
+                                                ', '.join(checkpoints)))
+
+    compression = _agent_package_compression(ctx, runner, agent_config)
+    relocated = _relocate_agent_package(agent_config, compression)
+    package_file = _downloaded_package_file(agent_config, compression)
+
+    if PACKAGE_CHECKPOINT not in checkpoints:
+        agent_package_url = get_agent_resource_url(
+            ctx, agent_config,
+            agent_package.PACKAGE_COMPRESSIONS[compression][0])
+        commands = _agent_package_commands(
+            ctx, runner, agent_config, agent_package_url, compression)
+        if commands:
+            runner.run_batch(commands)
+        for command in commands:
+            if command.ignore_errors and command.failed:
+                ctx.logger.warn('Error processing link: {0} [error={1}] - '
+                                'ignoring..'.format(command.command,
+                                                    command.output))
+
+    commands = []
+    if not relocated:
+        # This is for fixing virtualenv included in package paths
+        commands.append(agent_package.shebang_command(base_dir,
+                                                      phase='virtualenv'))
+    if package_file:
+        # Remove downloaded agent package
+        commands.append(remove_command(package_file, phase='download'))
 
     # Disable requiretty
     if agent_config['disable_requiretty']:
@@ -173,20 +249,212 @@ def install(ctx, runner, agent_config, **kwargs):
             ctx, agent_config, 'disable_requiretty_script_path')
         ctx.logger.debug("Removing requiretty in sudoers file")
         disable_requiretty_script = '{0}/disable-requiretty.sh'.format(
-            agent_config['base_dir'])
+            base_dir)
+        commands.extend([
+            BatchCommand(download_resource_command(
+                disable_requiretty_script_url, disable_requiretty_script,
+                get_host_facts(runner, agent_config))),
+            BatchCommand('chmod +x {0}'.format(disable_requiretty_script)),
+            BatchCommand('sudo {0}'.format(disable_requiretty_script))
+        ])
+
+    if CONFIGURATION_CHECKPOINT not in checkpoints:
+        if checkpoints:
+            # files left by the failed attempt would not be overwritten
+            runner.run('sudo rm -f {0}'.format(' '.join(
+                agent_config[key] for key in
+                ['includes_file', 'config_file', 'init_file'])))
+        set_autoscale_from_host(ctx, runner, agent_config)
+        # the installation is complete once the configuration is created
+        # if nothing is left to do after it
+        create_celery_configuration(
+            ctx, runner, agent_config, manager.get_resource,
+            checkpoint=(CONFIGURATION_CHECKPOINT if commands
+                        else INSTALLED_CHECKPOINT))
+    if commands:
+        commands.append(
+            _checkpoint_command(agent_config, INSTALLED_CHECKPOINT))
+        runner.run_batch(commands)
+
+
+def worker_exists(runner, agent_config):
+    """whether the agent is fully installed on the host
+
+    An agent installed before installations were checkpointed has no
+    checkpoints at all and is considered installed.
+    """
+    if not get_host_facts(runner, agent_config)['base_dir_exists']:
+        return False
+    checkpoints = _install_checkpoints(runner, agent_config)
+    return checkpoints is None or INSTALLED_CHECKPOINT in checkpoints
+
+
+def _install_checkpoints(runner, agent_config):
+    """returns the checkpoints an installation of the agent has recorded
+
+    Returns None for an agent installed without checkpoints.
+    """
+    return get_host_facts(runner, agent_config)['install_checkpoints']
+
+
+def _checkpoint_path(agent_config, checkpoint):
+    return '{0}/{1}/{2}'.format(agent_config['base_dir'],
+                                INSTALL_CHECKPOINTS_DIR, checkpoint)
 
-        download_resource_on_host(
-            ctx.logger, runner, disable_requiretty_script_url,
-            disable_requiretty_script)
 
-        runner.run('chmod +x {0}'.format(disable_requiretty_script))
+def _checkpoint_command(agent_config, checkpoint):
+    return touch_command(_checkpoint_path(agent_config, checkpoint))
 
-        runner.run('sudo {0}'.format(disable_requiretty_script))
+
+def _agent_package_compression(ctx, runner, agent_config):
+    """returns the compression of the agent package to install
+
+    A zstd compressed package is only installed on hosts having zstd.
+    """
+    compression = agent_config['agent_package_compression']
+    if compression == agent_package.ZSTD and \
+            not get_host_facts(runner, agent_config)['zstd']:
+        ctx.logger.warn('zstd was not found on the host, installing the '
+                        'gzip compressed agent package')
+        return agent_package.GZIP
+    return compression
+
+
+def _relocate_agent_package(agent_config, compression):
+    """whether the agent package is relocated to base_dir on the manager
+
+    Only a gzip compressed package streamed through the ssh session, and
+    not through the host's package cache, passes through the manager to
+    be relocated.
+    """
+    return (agent_config['relocate_agent_package'] and
+            compression == agent_package.GZIP and
+            agent_config['stream_agent_package'] and
+            not agent_config['package_cache'])
+
+
+def _downloaded_package_file(agent_config, compression):
+    """returns the path the host downloads the agent package to
+
+    Returns None when the package is streamed or cached instead.
+    """
+    if agent_config['stream_agent_package'] or \
+            agent_config['package_cache']:
+        return None
+    return '{0}/agent.{1}'.format(
+        agent_config['base_dir'],
+        agent_package.PACKAGE_COMPRESSIONS[compression][1])
+
+
+def _agent_package_commands(ctx, runner, agent_config, agent_package_url,
+                            compression):
+    """returns the commands installing the agent package into base_dir
+
+    Depending on the configuration, the package is downloaded by the host,
+    streamed through the ssh session or taken from the host's package
+    cache. A streamed package which is not cached is extracted right away.
+    The commands end with fixing the virtualenv's links and recording the
+    package checkpoint, none are returned if nothing is left to do.
+    """
+    base_dir = agent_config['base_dir']
+    stream_agent_package = agent_config['stream_agent_package']
+    extension = agent_package.PACKAGE_COMPRESSIONS[compression][1]
+    host_facts = get_host_facts(runner, agent_config)
+    relocated = _relocate_agent_package(agent_config, compression)
+    # creates base_dir, recording that an installation started there
+    start_command = mkdir_command('{0}/{1}'.format(base_dir,
+                                                   INSTALL_CHECKPOINTS_DIR))
+    # configuring virtualenv, unless the package was relocated while it
+    # was streamed
+    completion_commands = []
+    if not relocated:
+        completion_commands = agent_package.virtualenv_link_commands(
+            base_dir, ignore_errors=True, phase='virtualenv')
+    completion_commands.append(
+        _checkpoint_command(agent_config, PACKAGE_CHECKPOINT))
+
+    if agent_config['package_cache']:
+        cache_dir = agent_config['package_cache_dir']
+        checksum = package_cache.get_package_checksum(agent_package_url)
+        cached = package_cache.cached_package_path(cache_dir, checksum,
+                                                   extension)
+        prepare_cache_dir = BatchCommand(
+            package_cache.prepare_cache_dir_command(cache_dir))
+        if stream_agent_package:
+            cache_hit = BatchCommand(
+                package_cache.cache_hit_command(cache_dir, checksum,
+                                                extension),
+                ignore_errors=True)
+            runner.run_batch([prepare_cache_dir, cache_hit])
+            if cache_hit.failed:
+                ctx.logger.debug('Streaming agent package from: {0} to '
+                                 'the package cache'.format(agent_package_url))
+                with runner.timer.phase('download'):
+                    runner.run_with_input(
+                        package_cache.store_command(cache_dir, checksum,
+                                                    extension),
+                        read_resource_chunks(agent_package_url))
+            commands = []
+        else:
+            ctx.logger.debug('Fetching agent package from: {0} unless it is '
+                             'cached'.format(agent_package_url))
+            commands = [
+                prepare_cache_dir,
+                BatchCommand(package_cache.fetch_command(
+                    agent_package_url, cache_dir, checksum, extension,
+                    host_facts), phase='download')
+            ]
+        ctx.logger.debug('Using cached agent package: {0}'.format(cached))
+        commands.extend([
+            start_command,
+            BatchCommand(agent_package.extract_command(
+                cached, base_dir, compression, host_facts), phase='extract'),
+            BatchCommand(package_cache.evict_command(
+                cache_dir, agent_config['package_cache_size'], cached))
+        ])
+        return commands + completion_commands
+
+    if stream_agent_package:
+        # the package is piped through the ssh session into tar, so the
+        # host needs no route to the file server and nothing is left to
+        # clean up
+        ctx.logger.debug(
+            'Streaming agent package from: {0}'.format(agent_package_url))
+        # the package is extracted as it is downloaded
+        chunks = read_resource_chunks(agent_package_url)
+        command = '{0} && {1}'.format(
+            start_command.command, agent_package.extract_command(
+                '-', base_dir, compression, host_facts))
+        if relocated:
+            chunks = agent_package.relocate_package_chunks(chunks, base_dir)
+            # only the checkpoint is left, it is recorded right away
+            command = '{0} && {1}'.format(
+                command, completion_commands.pop().command)
+        with runner.timer.phase('download'):
+            runner.run_with_input(command, chunks)
+        return completion_commands
+
+    ctx.logger.debug(
+        'Downloading agent package from: {0}'.format(agent_package_url))
+    package_file = _downloaded_package_file(agent_config, compression)
+    commands = [
+        start_command,
+        BatchCommand(download_resource_command(
+            agent_package_url, package_file, host_facts), phase='download'),
+        BatchCommand(agent_package.extract_command(
+            package_file, base_dir, compression, host_facts),
+            phase='extract')
+    ]
+    return commands + completion_commands
 
 
 @operation
 @init_worker_installer
 def uninstall(ctx, runner, agent_config, **kwargs):
+    uninstall_agent(ctx, runner, agent_config)
+
+
+def uninstall_agent(ctx, runner, agent_config):
     ctx.logger.info(
         'Uninstalling cloudify agent {0}. '
         'Connection details --> {1}'
@@ -200,46 +468,67 @@ def uninstall(ctx, runner, agent_config, **kwargs):
         agent_config['init_file'], agent_config['config_file']
     ]
     folders_to_delete = [agent_config['base_dir']]
-    delete_files_if_exist(ctx, agent_config, runner, files_to_delete)
-    delete_folders_if_exist(ctx, agent_config, runner, folders_to_delete)
+    return delete_if_exist(ctx, agent_config, runner,
+                           files_to_delete, folders_to_delete)
 
 
-def delete_files_if_exist(ctx, agent_config, runner, files):
-    missing_files = []
-    for file_to_delete in files:
-        if runner.exists(file_to_delete):
-            runner.run("sudo rm {0}".format(file_to_delete))
-        else:
-            missing_files.append(file_to_delete)
-    if missing_files:
+def delete_if_exist(ctx, agent_config, runner, files, folders):
+    """deletes files and folders in a single remote invocation
+
+    Returns the paths which could not be found.
+    """
+    commands = []
+    for path in files:
+        commands.append(BatchCommand(
+            '[ -e {0} ] || exit {1}; sudo rm {0}'.format(
+                path, MISSING_PATH_CODE),
+            ignore_errors=True))
+    for path in folders:
+        commands.append(BatchCommand(
+            '[ -e {0} ] || exit {1}; sudo rm -rf {0}'.format(
+                path, MISSING_PATH_CODE),
+            ignore_errors=True))
+    if not commands:
+        return []
+    runner.run_batch(commands)
+
+    missing_paths = []
+    for path, command in zip(files + folders, commands):
+        if command.code == MISSING_PATH_CODE:
+            missing_paths.append(path)
+        elif command.failed:
+            raise FabricRunnerException(command.command,
+                                        command.code,
+                                        command.output)
+    if missing_paths:
         ctx.logger.debug(
-            "Could not find files {0} while trying to uninstall worker {1}"
-            .format(missing_files, agent_config['name']))
+            'Could not find {0} while trying to uninstall worker {1}'
+            .format(missing_paths, agent_config['name']))
+    return missing_paths
+
+
+def delete_files_if_exist(ctx, agent_config, runner, files):
+    delete_if_exist(ctx, agent_config, runner, files, [])
 
 
 def delete_folders_if_exist(ctx, agent_config, runner, folders):
-    missing_folders = []
-    for folder_to_delete in folders:
-        if runner.exists(folder_to_delete):
-            runner.run('sudo rm -rf {0}'.format(folder_to_delete))
-        else:
-            missing_folders.append(folder_to_delete)
-    if missing_folders:
-        ctx.logger.debug(
-            'Could not find folders {0} while trying to uninstall worker {1}'
-            .format(missing_folders, agent_config['name']))
+    delete_if_exist(ctx, agent_config, runner, [], folders)
 
 
 @operation
 @init_worker_installer
 def stop(ctx, runner, agent_config, **kwargs):
+    stop_agent(ctx, runner, agent_config)
+
+
+def stop_agent(ctx, runner, agent_config):
     ctx.logger.info(
         'Stopping cloudify agent {0}. '
         'Connection details --> {1}'
         .format(agent_config['name'],
                 connection_details(agent_config)))
 
-    if runner.exists(agent_config['init_file']):
+    if get_host_facts(runner, agent_config)['init_file_exists']:
         runner.run(
             "sudo service celeryd-{0} stop".format(agent_config["name"]))
     else:
@@ -257,8 +546,13 @@ def start(ctx, runner, agent_config, **kwargs):
         .format(agent_config['name'],
                 connection_details(agent_config)))
 
-    runner.run("sudo service celeryd-{0} start".format(agent_config["name"]))
+    start_agent(runner, agent_config)
+
 
+def start_agent(runner, agent_config):
+    with runner.timer.phase('start'):
+        runner.run("sudo service celeryd-{0} start".format(
+            agent_config["name"]))
     _wait_for_started(runner, agent_config)
 
 
@@ -274,19 +568,98 @@ def restart(ctx, runner, agent_config, **kwargs):
     restart_celery_worker(runner, agent_config)
 
 
+@operation
+def status(ctx, **kwargs):
+    """checks whether the agent is alive
+
+    The agent's worker is pinged through the broker first. Only if it
+    does not reply is the agent's host asked, over ssh, whether the
+    agent's service runs, and even then the host is not probed for its
+    facts the way the other operations do. Returns whether the agent is
+    alive.
+    """
+    agent_config = get_agent_configuration(ctx, kwargs)
+    worker_name = celery_worker_name(agent_config['name'])
+    try:
+        alive = worker_name in ping_workers([worker_name])
+    except Exception as e:
+        ctx.logger.debug('Failed pinging worker {0} [error={1}]'
+                         .format(worker_name, str(e)))
+        alive = False
+    checked_by = 'broker'
+    if not alive:
+        checked_by = 'ssh'
+        runner = create_runner(ctx, agent_config)
+        try:
+            alive = agent_service_running(runner, agent_config)
+        finally:
+            runner.close()
+    ctx.logger.info('Cloudify agent {0} is {1} [checked by {2}]'
+                    .format(agent_config['name'],
+                            'alive' if alive else 'not running',
+                            checked_by))
+    return alive
+
+
+def celery_worker_name(agent_name):
+    return 'celery@{0}'.format(agent_name)
+
+
+def ping_workers(worker_names, timeout=DEFAULT_PING_TIMEOUT):
+    """pings many workers with a single broadcast
+
+    Returns the names of the workers which replied before the timeout.
+    The broadcast ends as soon as all of them replied.
+    """
+    if not worker_names:
+        return set()
+    inspect = celery_client.control.inspect(destination=list(worker_names),
+                                            timeout=timeout,
+                                            limit=len(worker_names))
+    replies = inspect.ping() or {}
+    return set(replies) & set(worker_names)
+
+
+def agent_service_running(runner, agent_config):
+    """returns whether the agent's service runs on its host, in a single
+    remote invocation"""
+    command = BatchCommand('sudo service celeryd-{0} status'.format(
+        agent_config['name']), ignore_errors=True)
+    runner.run_batch([command])
+    return command.code == 0
+
+
 def get_agent_ip(ctx, agent_config):
     if is_on_management_worker(ctx):
         return utils.get_manager_ip()
     return agent_config['host']
 
 
-def create_celery_configuration(ctx, runner, agent_config, resource_loader):
-    create_celery_includes_file(ctx, runner, agent_config)
-    loader = jinja2.FunctionLoader(resource_loader)
-    env = jinja2.Environment(loader=loader)
+def create_celery_configuration(ctx, runner, agent_config, resource_loader,
+                                checkpoint=None):
+    """creates the celery includes, config and init files
+
+    If a checkpoint is given, it is recorded along with the files.
+    """
+    with runner.timer.phase('render'):
+        files = render_celery_configuration(ctx, agent_config,
+                                            resource_loader)
+    if checkpoint:
+        files.append((_checkpoint_path(agent_config, checkpoint), '',
+                      None, False))
+    with runner.timer.phase('put'):
+        runner.put_many(files)
+
+
+def render_celery_configuration(ctx, agent_config, resource_loader):
+    """returns the celery includes, config and init files to create
+
+    The files are returned as put_many entries.
+    """
     config_template_path = get_agent_resource_local_path(
         ctx, agent_config, 'celery_config_path')
-    config_template = env.get_template(config_template_path)
+    config_template = template_cache.get_template(resource_loader,
+                                                  config_template_path)
     config_template_values = {
         'includes_file_path': agent_config['includes_file'],
         'celery_base_dir': agent_config['celery_base_dir'],
@@ -297,7 +670,10 @@ def create_celery_configuration(ctx, runner, agent_config, resource_loader):
         'celery_user': agent_config['user'],
         'celery_group': agent_config['user'],
         'worker_autoscale': '{0},{1}'.format(agent_config['max_workers'],
-                                             agent_config['min_workers'])
+                                             agent_config['min_workers']),
+        'performance': agent_config['performance'],
+        'worker_performance_opts': celery_performance_options(
+            agent_config['performance'])
     }
 
     ctx.logger.debug(
@@ -307,7 +683,8 @@ def create_celery_configuration(ctx, runner, agent_config, resource_loader):
     config = config_template.render(config_template_values)
     init_template_path = get_agent_resource_local_path(
         ctx, agent_config, 'celery_init_path')
-    init_template = env.get_template(init_template_path)
+    init_template = template_cache.get_template(resource_loader,
+                                                init_template_path)
     init_template_values = {
         'celery_base_dir': agent_config['celery_base_dir'],
         'worker_modifier': agent_config['name']
@@ -319,32 +696,54 @@ def create_celery_configuration(ctx, runner, agent_config, resource_loader):
 
     init = init_template.render(init_template_values)
 
-    ctx.logger.debug(
-        'Creating celery config and init files [cloudify_agent={0}]'.format(
-            agent_config))
-
-    runner.put(agent_config['config_file'], config, use_sudo=True)
-    runner.put(agent_config['init_file'], init, use_sudo=True)
-
-
-def create_celery_includes_file(ctx, runner, agent_config):
     # build initial includes
     includes_list = get_celery_includes_list()
-    runner.put(agent_config['includes_file'], 'INCLUDES={0}\n'.format(
-        ','.join(includes_list)))
+    includes = 'INCLUDES={0}\n'.format(','.join(includes_list))
 
-    ctx.logger.debug('Created celery includes file [file=%s, content=%s]',
-                     agent_config['includes_file'],
-                     includes_list)
+    ctx.logger.debug(
+        'Creating celery includes, config and init files '
+        '[cloudify_agent={0}, includes={1}]'.format(agent_config,
+                                                    includes_list))
+
+    return [
+        (agent_config['includes_file'], includes, None, False),
+        (agent_config['config_file'], config, None, True),
+        (agent_config['init_file'], init, 0755, True)
+    ]
 
 
-def worker_exists(runner, agent_config):
-    return runner.exists(agent_config['base_dir'])
+def celery_performance_options(performance):
+    """returns the celery worker options applying the performance settings
+
+    Settings without a worker option are given as configuration after
+    --, so the options are to be placed last. Empty if no setting is set.
+    """
+    options = []
+    if performance['pool']:
+        options.append('--pool={0}'.format(performance['pool']))
+    if performance['max_tasks_per_child']:
+        options.append('--maxtasksperchild={0}'.format(
+            performance['max_tasks_per_child']))
+    config = []
+    if performance['prefetch_multiplier'] is not None:
+        config.append('celeryd.prefetch_multiplier={0}'.format(
+            performance['prefetch_multiplier']))
+    if performance['broker_heartbeat'] is not None:
+        config.append('broker.heartbeat={0}'.format(
+            performance['broker_heartbeat']))
+    if performance['acks_late'] is not None:
+        config.append('celery.acks_late={0}'.format(
+            str(performance['acks_late']).lower()))
+    if config:
+        options.append('--')
+        options.extend(config)
+    return ' '.join(options)
 
 
 def restart_celery_worker(runner, agent_config):
-    runner.run("sudo service celeryd-{0} restart".format(
-        agent_config['name']))
+    with runner.timer.phase('start'):
+        runner.run("sudo service celeryd-{0} restart".format(
+            agent_config['name']))
     _wait_for_started(runner, agent_config)
 
 
@@ -357,20 +756,7 @@ def _delete_amqp_queues(worker_name):
     # re-used if vm gets re-created by auto-heal.
     # Deleting the queues is a workaround for celery problems this creates.
     # Having unique worker names is probably a better long-term strategy.
-    client = amqp_client.create_client()
-    try:
-        channel = client.connection.channel()
-
-        # celery worker queue
-        channel.queue_delete(worker_name)
-
-        # celery management queue
-        channel.queue_delete('celery@{0}.celery.pidbox'.format(worker_name))
-    finally:
-        try:
-            client.close()
-        except Exception:
-            pass
+    delete_worker_queues([worker_name])
 
 
 def _verify_no_celery_error(runner, agent_config):
@@ -387,18 +773,101 @@ def _verify_no_celery_error(runner, agent_config):
             'Celery worker failed to start:\n{0}'.format(output))
 
 
+class WorkerEventReceiver(EventReceiver):
+    """
+    Receives the worker events of a single worker.
+
+    Only that worker is asked to send a heartbeat once the receiver is
+    ready, so a worker which went online before the receiver started is
+    detected as well.
+    """
+
+    def __init__(self, channel, worker_name, handlers=None):
+        super(WorkerEventReceiver, self).__init__(channel,
+                                                  handlers=handlers,
+                                                  routing_key='worker.#',
+                                                  app=celery_client)
+        self.worker_name = worker_name
+
+    def wakeup_workers(self, channel=None):
+        self.app.control.broadcast('heartbeat',
+                                   connection=self.connection,
+                                   channel=channel,
+                                   destination=[self.worker_name])
+
+
+def _wait_for_worker_event(worker_name, timeout):
+    """waits for an online or heartbeat event of the worker
+
+    Returns whether an event arrived before the timeout.
+    """
+    events = []
+
+    def on_event(event):
+        if event.get('hostname') == worker_name:
+            events.append(event)
+
+    handlers = {
+        'worker-online': on_event,
+        'worker-heartbeat': on_event
+    }
+    with celery_client.connection() as connection:
+        receiver = WorkerEventReceiver(connection, worker_name, handlers)
+        try:
+            for _ in receiver.itercapture(
+                    timeout=max(int(math.ceil(timeout - time.time())), 1)):
+                if events:
+                    return True
+                if time.time() >= timeout:
+                    return False
+        except socket.timeout:
+            pass
+    return bool(events)
+
+
+def _poll_worker_stats(worker_name, timeout, interval):
+    """polls the worker's stats with an exponential backoff
+
+    Returns whether the worker replied before the timeout. The worker is
+    asked at least once, even if the timeout already passed.
+    """
+    inspect = celery_client.control.inspect(destination=[worker_name])
+    while True:
+        stats = (inspect.stats() or {}).get(worker_name)
+        if stats:
+            return True
+        if time.time() >= timeout:
+            return False
+        time.sleep(max(min(interval, timeout - time.time()), 0))
+        interval = min(interval * 2, MAX_WAIT_STARTED_INTERVAL)
+    return False
+
+
 def _wait_for_started(runner, agent_config):
+    with runner.timer.phase('readiness'):
+        _wait_for_worker_ready(runner, agent_config)
+
+
+def _wait_for_worker_ready(runner, agent_config):
     _verify_no_celery_error(runner, agent_config)
-    worker_name = 'celery@{0}'.format(agent_config['name'])
-    inspect = celery_client.control.inspect(destination=[worker_name])
+    worker_name = celery_worker_name(agent_config['name'])
     wait_started_timeout = agent_config['wait_started_timeout']
     timeout = time.time() + wait_started_timeout
-    interval = agent_config['wait_started_interval']
-    while time.time() < timeout:
-        stats = (inspect.stats() or {}).get(worker_name)
-        if stats:
-            return
-        time.sleep(interval)
+    try:
+        started = _wait_for_worker_event(worker_name, timeout)
+    except Exception as e:
+        ctx.logger.debug('Failed receiving events of worker {0}, polling '
+                         'its stats instead [error={1}]'
+                         .format(worker_name, str(e)))
+        started = None
+    if not started:
+        # the worker may not send heartbeats, or its events may have been
+        # dropped, so it is asked directly before giving up
+        started = _poll_worker_stats(worker_name,
+                                     timeout,
+                                     agent_config['wait_started_interval'])
+    if started:
+        return
     _verify_no_celery_error(runner, agent_config)
     celery_log_file = os.path.join(
         agent_config['base_dir'], 'work/celery.log')
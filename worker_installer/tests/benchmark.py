@@ -0,0 +1,311 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Benchmarks the agent lifecycle operations against local stand-ins.
+
+Every simulated host is an in-process ssh server running commands with
+the local shell (see stand_ins.py), rooted at a directory of its own:
+the agent is installed under that directory and the paths under /etc
+the installer writes to are redirected into it. ``sudo`` runs commands
+as the current user and ``service`` does nothing. The agent package and
+scripts are served by a fake file server and workers are considered
+started as soon as they are asked to start.
+
+Agents are installed and started, then stopped and uninstalled, with
+the bulk installer. For each host count, the remote round-trips, the
+bytes transferred and the wall clock per phase are reported:
+
+    python -m worker_installer.tests.benchmark --hosts 1 10 100
+
+--latency and --bandwidth put a SimulatedRunner in front of the runner,
+to see how the operations are affected by a slow network.
+"""
+
+import os
+import sys
+import copy
+import time
+import json
+import shutil
+import logging
+import tarfile
+import argparse
+import tempfile
+from StringIO import StringIO
+
+from mock import patch
+from fabric.api import env
+from fabric.state import output
+
+from cloudify.mocks import MockCloudifyContext
+
+from worker_installer import bulk
+from worker_installer.utils import RUNNERS
+from worker_installer.tests.stand_ins import FakeFileServer
+from worker_installer.tests.stand_ins import InProcessSSHServer
+from worker_installer.tests.stand_ins import SimulatedRunner
+
+DISTRO = 'Ubuntu'
+DISTRO_CODENAME = 'trusty'
+DEFAULT_HOSTS = [1, 10, 100]
+DEFAULT_PACKAGE_SIZE = 1024 * 1024
+
+SHIMS = {
+    # skips sudo's options and runs the command as the current user
+    'sudo': '#!/bin/sh\n'
+            'while [ "${1#-}" != "$1" ]; do shift; done\n'
+            'exec "$@"\n',
+    'service': '#!/bin/sh\nexit 0\n'
+}
+
+
+def agent_package(size):
+    """returns an agent package with a virtualenv of about ``size`` bytes"""
+    buf = StringIO()
+    tar = tarfile.open(fileobj=buf, mode='w:gz')
+
+    def add(name, content='', **kwargs):
+        info = tarfile.TarInfo('cloudify/agent/{0}'.format(name))
+        info.size = len(content)
+        for key, value in kwargs.items():
+            setattr(info, key, value)
+        tar.addfile(info, StringIO(content))
+
+    for name in ['python', 'celery', 'pip']:
+        add('env/bin/{0}'.format(name),
+            '#!/home/builder/env/bin/python\n', mode=0755)
+    add('env/lib/python2.7/site-packages/payload', os.urandom(size))
+    for link in ['archives', 'bin', 'include', 'lib']:
+        add('env/local/{0}'.format(link), type=tarfile.SYMTYPE,
+            linkname='/home/builder/env/{0}'.format(link))
+    tar.close()
+    return buf.getvalue()
+
+
+def _read_test_file(name):
+    with open(os.path.join(os.path.dirname(__file__), name)) as f:
+        return f.read()
+
+
+def _get_resource(resource_path):
+    if resource_path.endswith('celeryd-cloudify.conf.template'):
+        return _read_test_file('Ubuntu-celeryd-cloudify.conf.jinja2')
+    if resource_path.endswith('celeryd-cloudify.init.template'):
+        return _read_test_file('Ubuntu-celeryd-cloudify.init.jinja2')
+    raise RuntimeError('unexpected resource: {0}'.format(resource_path))
+
+
+def _rewriter(root):
+    def rewrite(command):
+        for path in ['/etc/init.d/', '/etc/default/']:
+            command = command.replace(path, root + path)
+        return command
+    return rewrite
+
+
+class Benchmark(object):
+
+    def __init__(self, work_dir, package_size=DEFAULT_PACKAGE_SIZE,
+                 concurrency=bulk.DEFAULT_CONCURRENCY, runner='fabric',
+                 stream_agent_package=False, relocate_agent_package=False,
+                 simulation=None):
+        self.work_dir = work_dir
+        self.concurrency = concurrency
+        self.runner = runner
+        self.stream_agent_package = stream_agent_package
+        self.relocate_agent_package = relocate_agent_package
+        self.simulation = simulation
+        shims_dir = os.path.join(work_dir, 'bin')
+        os.makedirs(shims_dir)
+        for name, content in SHIMS.items():
+            path = os.path.join(shims_dir, name)
+            with open(path, 'w') as f:
+                f.write(content)
+            os.chmod(path, 0755)
+        self.environment = {'PATH': os.pathsep.join([
+            shims_dir,
+            os.path.dirname(sys.executable),
+            os.environ['PATH']])}
+        self.file_server = FakeFileServer({
+            '/packages/agents/{0}-{1}-agent.tar.gz'.format(
+                DISTRO, DISTRO_CODENAME): agent_package(package_size),
+            '/packages/scripts/{0}-agent-disable-requiretty.sh'.format(
+                DISTRO): '#!/bin/sh\nexit 0\n'
+        })
+
+    def close(self):
+        self.file_server.close()
+
+    def run(self, hosts):
+        """installs and uninstalls agents on ``hosts`` simulated hosts
+
+        Returns a report per bulk action.
+        """
+        servers = []
+        configs = []
+        try:
+            for index in range(hosts):
+                root = os.path.join(self.work_dir, 'hosts', str(index))
+                for directory in ['etc/init.d', 'etc/default', 'home']:
+                    os.makedirs(os.path.join(root, directory))
+                server = InProcessSSHServer(environment=self.environment,
+                                            rewrite=_rewriter(root))
+                servers.append(server)
+                configs.append({
+                    'name': 'benchmark{0}'.format(index),
+                    'host': '127.0.0.1',
+                    'port': server.port,
+                    'user': InProcessSSHServer.USER,
+                    'password': InProcessSSHServer.PASSWORD,
+                    'home_dir': os.path.join(root, 'home'),
+                    'distro': DISTRO,
+                    'distro_codename': DISTRO_CODENAME,
+                    'delete_amqp_queues': False,
+                    'stream_agent_package': self.stream_agent_package,
+                    'relocate_agent_package': self.relocate_agent_package,
+                    'runner': self.runner
+                })
+                if self.simulation:
+                    configs[-1]['runner'] = 'simulated'
+                    configs[-1]['simulation'] = dict(self.simulation,
+                                                     runner=self.runner)
+            return [self._run_action(hosts, servers, configs, action, func)
+                    for action, func in [('install', bulk.install_many),
+                                         ('uninstall', bulk.uninstall_many)]]
+        finally:
+            for server in servers:
+                server.close()
+            shutil.rmtree(os.path.join(self.work_dir, 'hosts'))
+
+    def _run_action(self, hosts, servers, configs, action, func):
+        ctx = MockCloudifyContext(deployment_id='benchmark')
+        ctx.logger.setLevel(logging.WARNING)
+        before = self._counters(servers)
+        started = time.time()
+        results = func(ctx, copy.deepcopy(configs),
+                       concurrency=self.concurrency)
+        wall_clock = time.time() - started
+        after = self._counters(servers)
+
+        phases = {}
+        calls = {}
+        succeeded = [r for r in results if r['success']]
+        for result in succeeded:
+            for name, duration in result['timings']['phases'].items():
+                phases[name] = phases.get(name, 0) + duration
+            for method, call in result['timings']['calls'].items():
+                calls[method] = calls.get(method, 0) + call['count']
+        count = len(succeeded) or 1
+        return {
+            'action': action,
+            'hosts': hosts,
+            'failed': [r['error'] for r in results if not r['success']],
+            'wall_clock': round(wall_clock, 3),
+            'round_trips_per_host': round(
+                float(after['round_trips'] - before['round_trips']) /
+                hosts, 2),
+            'ssh_bytes': after['ssh_bytes'] - before['ssh_bytes'],
+            'file_server_bytes': (after['file_server_bytes'] -
+                                  before['file_server_bytes']),
+            'phases_per_host': dict((name, round(duration / count, 3))
+                                    for name, duration in phases.items()),
+            'calls_per_host': dict((method, round(float(c) / count, 2))
+                                   for method, c in calls.items())
+        }
+
+    def _counters(self, servers):
+        return {
+            'round_trips': sum(len(s.commands) for s in servers),
+            'ssh_bytes': sum(s.bytes_received + s.bytes_sent
+                             for s in servers),
+            'file_server_bytes': self.file_server.bytes_sent
+        }
+
+
+def format_report(report):
+    lines = ['{action} x{hosts}: {wall_clock:.2f}s wall clock, '
+             '{round_trips_per_host} round-trips per host, '
+             '{ssh_bytes} ssh bytes, {file_server_bytes} file server bytes'
+             .format(**report)]
+    for name, duration in sorted(report['phases_per_host'].items()):
+        lines.append('    {0:<12} {1:.3f}s per host'.format(name, duration))
+    for error in report['failed']:
+        lines.append('    FAILED: {0}'.format(error))
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks agent lifecycle operations against local '
+                    'stand-ins')
+    parser.add_argument('--hosts', type=int, nargs='+',
+                        default=DEFAULT_HOSTS)
+    parser.add_argument('--concurrency', type=int,
+                        default=bulk.DEFAULT_CONCURRENCY)
+    parser.add_argument('--package-size', type=int,
+                        default=DEFAULT_PACKAGE_SIZE)
+    parser.add_argument('--runner', default='fabric')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='simulated seconds added to every round-trip')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='simulated bytes per second')
+    parser.add_argument('--stream-agent-package', action='store_true')
+    parser.add_argument('--relocate-agent-package', action='store_true')
+    parser.add_argument('--json', action='store_true',
+                        help='print the reports as json')
+    args = parser.parse_args(args)
+
+    work_dir = tempfile.mkdtemp(prefix='agent-benchmark-')
+    os.environ['MANAGER_FILE_SERVER_URL'] = ''
+    os.environ['MANAGEMENT_IP'] = '127.0.0.1'
+    # a login shell would reset the PATH the shims are found on
+    env.shell = '/bin/bash -c'
+    for key in output.keys():
+        output[key] = False
+    # the pool's processes exit without closing their connections
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    simulation = None
+    if args.latency or args.bandwidth:
+        simulation = {'latency': args.latency, 'bandwidth': args.bandwidth}
+    benchmark = Benchmark(work_dir,
+                          package_size=args.package_size,
+                          concurrency=args.concurrency,
+                          runner=args.runner,
+                          stream_agent_package=args.stream_agent_package,
+                          relocate_agent_package=args.relocate_agent_package,
+                          simulation=simulation)
+    os.environ['MANAGER_FILE_SERVER_URL'] = benchmark.file_server.url
+    reports = []
+    try:
+        with patch('cloudify.manager.get_resource', _get_resource), \
+                patch('worker_installer.tasks._wait_for_worker_event',
+                      lambda worker_name, timeout: True), \
+                patch.dict(RUNNERS, simulated=SimulatedRunner):
+            for hosts in args.hosts:
+                for report in benchmark.run(hosts):
+                    reports.append(report)
+                    if not args.json:
+                        print format_report(report)
+    finally:
+        benchmark.close()
+        shutil.rmtree(work_dir)
+    if args.json:
+        print json.dumps(reports, indent=2, sort_keys=True)
+    return reports
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+In-process stand-ins for the hosts, the network and the file server the
+installer talks to, used by tests and benchmarks.
+"""
+
+import os
+import time
+import random
+import socket
+import hashlib
+import threading
+import subprocess
+import BaseHTTPServer
+import SocketServer
+
+import paramiko
+
+from cloudify.exceptions import NonRecoverableError
+
+from worker_installer.utils import RUNNERS
+from worker_installer.utils import FabricRunner
+from worker_installer.utils import FabricRunnerException
+from worker_installer.timing import timed
+
+
+class InProcessSSHServer(paramiko.ServerInterface):
+    """
+    A minimal ssh server running commands with the local shell.
+
+    Commands run with ``environment`` added to the server's environment,
+    after being passed through ``rewrite`` if given. The server counts
+    the commands it runs and the bytes it receives and sends.
+    """
+
+    USER = 'user'
+    PASSWORD = 'password'
+
+    # generating a key is slow, all servers share one
+    _host_key = None
+    _host_key_lock = threading.Lock()
+
+    def __init__(self, environment=None, rewrite=None):
+        self.commands = []
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self._environment = environment
+        self._rewrite = rewrite
+        self._counters_lock = threading.Lock()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(128)
+        self.port = self._socket.getsockname()[1]
+        with self._host_key_lock:
+            if InProcessSSHServer._host_key is None:
+                InProcessSSHServer._host_key = paramiko.RSAKey.generate(1024)
+        self._transports = []
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._socket.accept()
+            except socket.error:
+                return
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self._host_key)
+            transport.start_server(server=self)
+            self._transports.append(transport)
+
+    def close(self):
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if username == self.USER and password == self.PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        with self._counters_lock:
+            self.commands.append(command)
+        thread = threading.Thread(target=self._execute,
+                                  args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _execute(self, channel, command):
+        if self._rewrite:
+            command = self._rewrite(command)
+        env = None
+        if self._environment:
+            env = dict(os.environ)
+            env.update(self._environment)
+        process = subprocess.Popen(command, shell=True,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   env=env)
+        # fabric never closes stdin, so it is forwarded while the output
+        # is read rather than before
+        stdin_thread = threading.Thread(target=self._forward_stdin,
+                                        args=(channel, process))
+        stdin_thread.daemon = True
+        stdin_thread.start()
+        while True:
+            data = os.read(process.stdout.fileno(), 4096)
+            if not data:
+                break
+            with self._counters_lock:
+                self.bytes_sent += len(data)
+            channel.sendall(data)
+        channel.send_exit_status(process.wait())
+        # the channel is left for the client to close, closing it here
+        # could overtake paramiko's reply to the exec request
+        channel.shutdown_write()
+
+    def _forward_stdin(self, channel, process):
+        try:
+            while True:
+                data = channel.recv(4096)
+                if not data:
+                    break
+                with self._counters_lock:
+                    self.bytes_received += len(data)
+                process.stdin.write(data)
+        except (IOError, socket.error):
+            # the command exited without reading all of its input
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except IOError:
+                pass
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeFileServer(object):
+    """
+    Serves in-memory files over http, the way the manager's file server
+    does, counting the requests and the bytes it sends.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0),
+                                            self._handler_class())
+        self.url = 'http://127.0.0.1:{0}'.format(
+            self._server.server_address[1])
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_HEAD(self):
+                self._respond(body=False)
+
+            def do_GET(self):
+                self._respond(body=True)
+
+            def _respond(self, body):
+                content = server.files.get(self.path)
+                with server._lock:
+                    server.requests += 1
+                    if content is not None and body:
+                        server.bytes_sent += len(content)
+                if content is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(content)))
+                self.send_header('ETag', hashlib.md5(content).hexdigest())
+                self.end_headers()
+                if body:
+                    self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class SimulatedRunner(FabricRunner):
+    """
+    A runner simulating a slow or unreliable network in front of another.
+
+    Commands are executed by the runner named by the 'runner' key of the
+    agent's 'simulation' settings (fabric by default), each round-trip is
+    delayed by 'latency' seconds plus the time its bytes take at
+    'bandwidth' bytes per second (unlimited if not set), and fails with
+    probability 'failure_rate' before reaching the host. Failures are
+    drawn from a random generator seeded with 'seed', so a simulation can
+    be repeated. Every round-trip is recorded in ``trace``.
+
+    It is not one of the installer's runners, tests and benchmarks add it
+    to ``worker_installer.utils.RUNNERS`` as 'simulated' to use it.
+    """
+
+    def __init__(self, ctx, agent_config=None, local=None):
+        super(SimulatedRunner, self).__init__(ctx, agent_config, local)
+        simulation = dict((agent_config or {}).get('simulation') or {})
+        name = simulation.get('runner') or 'fabric'
+        if name not in RUNNERS or RUNNERS[name] is SimulatedRunner:
+            raise NonRecoverableError(
+                'Cannot simulate runner: {0}'.format(name))
+        self.latency = float(simulation.get('latency', 0))
+        self.bandwidth = float(simulation.get('bandwidth', 0))
+        self.failure_rate = float(simulation.get('failure_rate', 0))
+        self.trace = []
+        self._random = random.Random(simulation.get('seed'))
+        self._runner = RUNNERS[name](ctx, agent_config, local)
+        # connections are timed by the simulated runner's timer
+        self._runner._timer = self.timer
+
+    def _round_trip(self, method, command, execute, sent=0):
+        entry = {
+            'method': method,
+            'command': command,
+            'sent': len(command) + sent,
+            'received': 0,
+            'failed': False
+        }
+        self.trace.append(entry)
+        started = time.time()
+        try:
+            self._delay(entry['sent'])
+            time.sleep(self.latency)
+            if self._random.random() < self.failure_rate:
+                raise FabricRunnerException(command, -1,
+                                            'Simulated failure')
+            result = execute()
+            if isinstance(result, basestring):
+                entry['received'] = len(result)
+                self._delay(len(result))
+            return result
+        except Exception:
+            entry['failed'] = True
+            raise
+        finally:
+            entry['duration'] = time.time() - started
+
+    def _delay(self, size):
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    @timed
+    def run(self, command, shell_escape=None):
+        return self._round_trip(
+            'run', command,
+            lambda: self._runner.run(command, shell_escape))
+
+    @timed
+    def run_with_input(self, command, chunks):
+        sent = []
+
+        def counted_chunks():
+            for chunk in chunks:
+                sent.append(len(chunk))
+                self._delay(len(chunk))
+                yield chunk
+        try:
+            return self._round_trip(
+                'run_with_input', command,
+                lambda: self._runner.run_with_input(command,
+                                                    counted_chunks()))
+        finally:
+            self.trace[-1]['sent'] += sum(sent)
+
+    @timed
+    def exists(self, file_path):
+        return self._round_trip('exists', file_path,
+                                lambda: self._runner.exists(file_path))
+
+    @timed
+    def get(self, file_path, sink=None):
+        return self._round_trip('get', file_path,
+                                lambda: self._runner.get(file_path, sink))
+
+    def close(self):
+        self._runner.close()
@@ -0,0 +1,149 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import subprocess
+from StringIO import StringIO
+
+from worker_installer import agent_package
+
+
+SCRIPTS = {
+    'celery': '#!/home/builder/env/bin/python\nimport celery\n',
+    'activate': '# sourced, not run\nexport VIRTUAL_ENV\n'
+}
+
+
+def _package():
+    buf = StringIO()
+    tar = tarfile.open(fileobj=buf, mode='w:gz')
+
+    def add(name, content='', **kwargs):
+        info = tarfile.TarInfo('cloudify/agent/{0}'.format(name))
+        info.size = len(content)
+        for key, value in kwargs.items():
+            setattr(info, key, value)
+        tar.addfile(info, StringIO(content))
+
+    add('env/bin', type=tarfile.DIRTYPE, mode=0755)
+    for name, content in SCRIPTS.items():
+        add('env/bin/{0}'.format(name), content, mode=0755)
+    add('env/lib/python2.7/site-packages/payload', os.urandom(100000))
+    for link in agent_package.VIRTUALENV_LINKS:
+        add('env/local/{0}'.format(link), type=tarfile.SYMTYPE,
+            linkname='/home/builder/env/{0}'.format(link))
+    tar.close()
+    return buf.getvalue()
+
+
+def _chunks(content, chunk_size=4096):
+    for offset in range(0, len(content), chunk_size):
+        yield content[offset:offset + chunk_size]
+
+
+class ExtractCommandTest(unittest.TestCase):
+
+    def test_gzip(self):
+        self.assertEqual(
+            'tar -z -xf /base/agent.tar.gz --strip=2 -C /base',
+            agent_package.extract_command('/base/agent.tar.gz', '/base',
+                                          agent_package.GZIP, {}))
+
+    def test_gzip_with_pigz(self):
+        self.assertEqual(
+            'tar --use-compress-program=pigz -xf - --strip=2 -C /base',
+            agent_package.extract_command('-', '/base', agent_package.GZIP,
+                                          {'pigz': True}))
+
+    def test_zstd(self):
+        self.assertEqual(
+            'tar --use-compress-program=zstd -xf - --strip=2 -C /base',
+            agent_package.extract_command('-', '/base', agent_package.ZSTD,
+                                          {'pigz': True}))
+
+
+class RelocatePackageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.package = _package()
+
+    def _extract(self, name, package):
+        base_dir = os.path.join(self.temp_dir, name)
+        os.makedirs(base_dir)
+        process = subprocess.Popen(
+            agent_package.extract_command('-', base_dir, agent_package.GZIP,
+                                          {}),
+            shell=True, stdin=subprocess.PIPE)
+        process.communicate(package)
+        self.assertEqual(0, process.returncode)
+        return base_dir
+
+    def _layout(self, base_dir):
+        layout = {}
+        for root, dirs, files in os.walk(base_dir):
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    layout[path] = ('link', os.readlink(path))
+                elif os.path.isfile(path):
+                    with open(path) as f:
+                        layout[path] = ('file', f.read(),
+                                        os.stat(path).st_mode)
+        return layout
+
+    def test_relocate(self):
+        base_dir = os.path.join(self.temp_dir, 'relocated')
+        relocated = ''.join(agent_package.relocate_package_chunks(
+            _chunks(self.package), base_dir))
+        self._extract('relocated', relocated)
+        layout = self._layout(base_dir)
+        for link in agent_package.VIRTUALENV_LINKS:
+            self.assertEqual(
+                ('link', '{0}/env/{1}'.format(base_dir, link)),
+                layout['{0}/env/local/{1}'.format(base_dir, link)])
+        self.assertEqual(
+            '#!{0}/env/bin/python\nimport celery\n'.format(base_dir),
+            layout['{0}/env/bin/celery'.format(base_dir)][1])
+        self.assertEqual(SCRIPTS['activate'],
+                         layout['{0}/env/bin/activate'.format(base_dir)][1])
+
+    def _fix_up(self, native):
+        base_dir = self._extract('fixed', self.package)
+        for command in agent_package.virtualenv_link_commands(base_dir) + \
+                [agent_package.shebang_command(base_dir)]:
+            if native:
+                command.native()
+            else:
+                subprocess.check_call(command.command, shell=True)
+        layout = self._layout(base_dir)
+        shutil.rmtree(base_dir)
+        return base_dir, layout
+
+    def test_relocate_same_as_fixing_up(self):
+        base_dir, fixed = self._fix_up(native=False)
+        relocated = ''.join(agent_package.relocate_package_chunks(
+            _chunks(self.package), base_dir))
+        self._extract('fixed', relocated)
+        self.assertEqual(fixed, self._layout(base_dir))
+
+    def test_native_same_as_shell_fix_up(self):
+        self.assertEqual(self._fix_up(native=False),
+                         self._fix_up(native=True))
@@ -0,0 +1,109 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import time
+import unittest
+
+from mock import patch
+from mock import MagicMock
+from pika.exceptions import ConnectionClosed
+from pika.exceptions import ChannelClosed
+
+from worker_installer.amqp_pool import AMQPChannelPool
+from worker_installer.amqp_pool import delete_worker_queues
+
+
+class AMQPChannelPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clients = []
+        self.pool = AMQPChannelPool(idle_timeout=60,
+                                    create_client=self._create_client)
+        self.addCleanup(self.pool.close)
+
+    def _create_client(self):
+        client = MagicMock()
+        client.connection.is_open = True
+        client.connection.channel.return_value.is_open = True
+        self.clients.append(client)
+        return client
+
+    def _deleted_queues(self):
+        return [c[0][0] for client in self.clients
+                for c in client.connection.channel.return_value
+                .queue_delete.call_args_list]
+
+    def test_delete_worker_queues(self):
+        delete_worker_queues(['agent1', 'agent2'], pool=self.pool)
+        self.assertEqual(['agent1', 'celery@agent1.celery.pidbox',
+                          'agent2', 'celery@agent2.celery.pidbox'],
+                         self._deleted_queues())
+        self.assertEqual(1, len(self.clients))
+
+    def test_connection_reused(self):
+        for name in ['agent1', 'agent2', 'agent3']:
+            delete_worker_queues([name], pool=self.pool)
+        self.assertEqual(1, len(self.clients))
+        self.assertEqual(1, self.clients[0].connection.channel.call_count)
+        self.assertFalse(self.clients[0].close.called)
+
+    def test_closed_channel_reopened(self):
+        delete_worker_queues(['agent1'], pool=self.pool)
+        channel = self.clients[0].connection.channel.return_value
+        channel.is_open = False
+        delete_worker_queues(['agent2'], pool=self.pool)
+        self.assertEqual(2, len(self.clients))
+        self.clients[0].close.assert_called_once_with()
+
+    def test_idle_connection_replaced(self):
+        delete_worker_queues(['agent1'], pool=self.pool)
+        with patch('time.time', MagicMock(return_value=time.time() + 120)):
+            delete_worker_queues(['agent2'], pool=self.pool)
+        self.assertEqual(2, len(self.clients))
+
+    def test_connection_dropped_on_error(self):
+        delete_worker_queues(['agent1'], pool=self.pool)
+        channel = self.clients[0].connection.channel.return_value
+        channel.queue_delete.side_effect = RuntimeError('broker error')
+        self.assertRaises(RuntimeError, delete_worker_queues,
+                          ['agent2'], pool=self.pool)
+        self.clients[0].close.assert_called_once_with()
+        delete_worker_queues(['agent3'], pool=self.pool)
+        self.assertEqual(2, len(self.clients))
+
+    def test_stale_connection_retried(self):
+        delete_worker_queues(['agent1'], pool=self.pool)
+        # closed by the broker, though its flags still say it is open
+        channel = self.clients[0].connection.channel.return_value
+        channel.queue_delete.side_effect = ConnectionClosed()
+        delete_worker_queues(['agent2'], pool=self.pool)
+        self.assertEqual(2, len(self.clients))
+        self.clients[0].close.assert_called_once_with()
+        self.assertEqual(['agent2', 'celery@agent2.celery.pidbox'],
+                         [c[0][0] for c in self.clients[1].connection
+                          .channel.return_value.queue_delete.call_args_list])
+
+    def test_fresh_connection_not_retried(self):
+        self.pool = AMQPChannelPool(create_client=MagicMock(
+            side_effect=self._closed_channel_client))
+        self.assertRaises(ChannelClosed, delete_worker_queues,
+                          ['agent1'], pool=self.pool)
+        self.assertEqual(1, len(self.clients))
+
+    def _closed_channel_client(self):
+        client = self._create_client()
+        client.connection.channel.return_value.queue_delete.side_effect = \
+            ChannelClosed()
+        return client
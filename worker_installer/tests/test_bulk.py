@@ -0,0 +1,106 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import unittest
+
+from mock import patch
+
+from cloudify.mocks import MockCloudifyContext
+from cloudify.exceptions import NonRecoverableError
+
+from worker_installer import bulk
+
+
+def _mock_install_and_start(ctx, agent_config, start):
+    if agent_config['host'] == 'bad_host':
+        raise NonRecoverableError('cannot connect')
+    agent_config['pid'] = os.getpid()
+
+
+def _mock_check_status(ctx, agent_config, flag):
+    if agent_config['host'] == 'bad_host':
+        raise NonRecoverableError('cloudify agent is not running')
+
+
+class InstallManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = MockCloudifyContext(deployment_id='deployment_id')
+
+    @patch('worker_installer.bulk._install_and_start',
+           _mock_install_and_start)
+    def test_install_many(self):
+        configs = [{'name': 'agent{0}'.format(i),
+                    'host': '10.0.0.{0}'.format(i)} for i in range(5)]
+        configs[2]['host'] = 'bad_host'
+        results = bulk.install_many(self.ctx, configs, concurrency=3)
+
+        self.assertEqual(['agent{0}'.format(i) for i in range(5)],
+                         [r['name'] for r in results])
+        self.assertEqual([True, True, False, True, True],
+                         [r['success'] for r in results])
+        self.assertIn('cannot connect', results[2]['error'])
+        for result in results:
+            self.assertTrue(result['duration'] >= 0)
+        # configurations are completed in the pool's processes
+        self.assertNotIn('pid', configs[0])
+
+    def test_install_many_no_hosts(self):
+        self.assertEqual([], bulk.install_many(self.ctx, []))
+
+    def test_missing_host(self):
+        results = bulk.install_many(self.ctx, [{'name': 'agent'}])
+        self.assertFalse(results[0]['success'])
+        self.assertIn('Missing host', results[0]['error'])
+
+    @patch('worker_installer.bulk._stop_and_uninstall',
+           _mock_install_and_start)
+    def test_uninstall_many(self):
+        configs = [{'name': 'agent{0}'.format(i),
+                    'host': '10.0.0.{0}'.format(i)} for i in range(3)]
+        configs[0]['host'] = 'bad_host'
+        results = bulk.uninstall_many(self.ctx, configs, concurrency=2)
+        self.assertEqual([False, True, True],
+                         [r['success'] for r in results])
+
+    @patch('worker_installer.bulk._check_status', _mock_check_status)
+    @patch('worker_installer.tasks.ping_workers')
+    def test_status_many(self, ping_workers):
+        ping_workers.return_value = set(['celery@agent0', 'celery@agent2'])
+        configs = [{'name': 'agent{0}'.format(i),
+                    'host': '10.0.0.{0}'.format(i)} for i in range(4)]
+        configs[3]['host'] = 'bad_host'
+        results = bulk.status_many(self.ctx, configs, timeout=5)
+
+        self.assertEqual(1, ping_workers.call_count)
+        self.assertEqual((['celery@agent{0}'.format(i) for i in range(4)], 5),
+                         ping_workers.call_args[0])
+        self.assertEqual(['agent{0}'.format(i) for i in range(4)],
+                         [r['name'] for r in results])
+        self.assertEqual([True, True, True, False],
+                         [r['alive'] for r in results])
+        self.assertEqual(['broker', 'ssh', 'broker', 'ssh'],
+                         [r['checked_by'] for r in results])
+        self.assertIn('not running', results[3]['error'])
+
+    @patch('worker_installer.bulk._check_status', _mock_check_status)
+    @patch('worker_installer.tasks.ping_workers',
+           side_effect=IOError('broker down'))
+    def test_status_many_without_broker(self, ping_workers):
+        results = bulk.status_many(self.ctx, [{'name': 'agent',
+                                               'host': '10.0.0.1'}])
+        self.assertEqual([True], [r['alive'] for r in results])
+        self.assertEqual(['ssh'], [r['checked_by'] for r in results])
@@ -15,13 +15,24 @@
 
 import unittest
 import os
+import time
 import getpass
 import pwd
 from os import path
+from mock import patch
+from mock import MagicMock
 from worker_installer import init_worker_installer
 from worker_installer import DEFAULT_MIN_WORKERS, DEFAULT_MAX_WORKERS
-from worker_installer import FabricRunner
+from worker_installer import (DEFAULT_PACKAGE_CACHE_DIR,
+                              DEFAULT_PACKAGE_CACHE_SIZE)
+from worker_installer.utils import FabricRunner
+from worker_installer import set_autoscale_from_host
+from worker_installer import AUTOSCALE_PROPERTY
+from worker_installer import configuration_cache
+from worker_installer import ConfigurationCache
 from worker_installer.tasks import create_celery_configuration
+from worker_installer.tasks import template_cache
+from worker_installer.tasks import TemplateCache
 from cloudify.mocks import MockCloudifyContext
 from cloudify.context import BootstrapContext
 from cloudify.exceptions import NonRecoverableError
@@ -40,6 +51,7 @@ class CeleryWorkerConfigurationTest(unittest.TestCase):
 
     def setUp(self):
         os.environ['MANAGEMENT_USER'] = getpass.getuser()
+        configuration_cache.clear()
 
     def test_deployment_config(self):
         ctx = MockCloudifyContext(deployment_id='deployment_id')
@@ -138,6 +150,56 @@ class CeleryWorkerConfigurationTest(unittest.TestCase):
             conf = m(ctx, cloudify_agent=config)
             self.assertEqual(expected, conf['disable_requiretty'])
 
+    def test_stream_agent_package_config(self):
+        ctx = MockCloudifyContext(deployment_id='test')
+        config = {'distro': 'Ubuntu', 'distro_codename': 'trusty'}
+        conf = m(ctx, cloudify_agent=config)
+        self.assertFalse(conf['stream_agent_package'])
+        config = {'stream_agent_package': 'true',
+                  'distro': 'Ubuntu',
+                  'distro_codename': 'trusty'}
+        conf = m(ctx, cloudify_agent=config)
+        self.assertTrue(conf['stream_agent_package'])
+
+    def test_relocate_agent_package_config(self):
+        ctx = MockCloudifyContext(deployment_id='test')
+        config = {'distro': 'Ubuntu', 'distro_codename': 'trusty'}
+        conf = m(ctx, cloudify_agent=config)
+        self.assertFalse(conf['relocate_agent_package'])
+        config = {'relocate_agent_package': 'true',
+                  'distro': 'Ubuntu',
+                  'distro_codename': 'trusty'}
+        conf = m(ctx, cloudify_agent=config)
+        self.assertTrue(conf['relocate_agent_package'])
+
+    def test_agent_package_compression_config(self):
+        ctx = MockCloudifyContext(deployment_id='test')
+        config = {'distro': 'Ubuntu', 'distro_codename': 'trusty'}
+        conf = m(ctx, cloudify_agent=config)
+        self.assertEqual('gzip', conf['agent_package_compression'])
+        config = {'agent_package_compression': 'zstd',
+                  'distro': 'Ubuntu',
+                  'distro_codename': 'trusty'}
+        conf = m(ctx, cloudify_agent=config)
+        self.assertEqual('zstd', conf['agent_package_compression'])
+        config = {'agent_package_compression': 'bzip2',
+                  'distro': 'Ubuntu',
+                  'distro_codename': 'trusty'}
+        self.assertRaises(NonRecoverableError, m, ctx, cloudify_agent=config)
+
+    def test_package_cache_config(self):
+        ctx = MockCloudifyContext(deployment_id='test')
+        config = {'distro': 'Ubuntu', 'distro_codename': 'trusty'}
+        conf = m(ctx, cloudify_agent=config)
+        self.assertFalse(conf['package_cache'])
+        self.assertEqual(DEFAULT_PACKAGE_CACHE_DIR, conf['package_cache_dir'])
+        self.assertEqual(DEFAULT_PACKAGE_CACHE_SIZE,
+                         conf['package_cache_size'])
+        config = {'package_cache_size': 'big',
+                  'distro': 'Ubuntu',
+                  'distro_codename': 'trusty'}
+        self.assertRaises(NonRecoverableError, m, ctx, cloudify_agent=config)
+
     def test_autoscale_configuration(self):
         node_id = 'node_id'
         ctx = MockCloudifyContext(
@@ -276,6 +338,95 @@ class CeleryWorkerConfigurationTest(unittest.TestCase):
         self.assertEqual(conf['min_workers'], 0)
         self.assertEqual(conf['max_workers'], 5)
 
+    def test_illegal_auto_autoscale_configuration(self):
+        ctx = MockCloudifyContext(deployment_id='test')
+        for config in [{'autoscale': 'dynamic'},
+                       {'autoscale': 'auto', 'worker_memory': 0},
+                       {'autoscale': 'auto', 'workers_per_cpu': 'many'}]:
+            config.update({'distro': 'Ubuntu', 'distro_codename': 'trusty'})
+            self.assertRaises(NonRecoverableError, m, ctx,
+                              cloudify_agent=config)
+
+    def _autoscale(self, cpu_count, memory_available, **config):
+        ctx = MockCloudifyContext(node_id='node_id', runtime_properties={})
+        runner = MagicMock()
+        runner.host_facts = {'cpu_count': cpu_count,
+                             'memory_available': memory_available}
+        agent_config = {'name': 'agent',
+                        'autoscale': 'auto',
+                        'workers_per_cpu': 2,
+                        'worker_memory': 256,
+                        'min_workers': 2,
+                        'max_workers': 5}
+        agent_config.update(config)
+        set_autoscale_from_host(ctx, runner, agent_config)
+        return ctx, (agent_config['min_workers'],
+                     agent_config['max_workers'])
+
+    def test_auto_autoscale(self):
+        gigabyte = 1024 * 1024 * 1024
+        # bound by cpus
+        self.assertEqual((1, 2), self._autoscale(1, gigabyte)[1])
+        # bound by memory
+        self.assertEqual((32, 32), self._autoscale(64, 8 * gigabyte)[1])
+        self.assertEqual((1, 1), self._autoscale(2, 100 * 1024 * 1024)[1])
+        self.assertEqual((4, 16), self._autoscale(
+            4, 8 * gigabyte, workers_per_cpu=4, worker_memory=512)[1])
+        ctx, _ = self._autoscale(1, gigabyte)
+        self.assertEqual({'min_workers': 1,
+                          'max_workers': 2,
+                          'cpu_count': 1,
+                          'memory_available': gigabyte,
+                          'workers_per_cpu': 2,
+                          'worker_memory': 256},
+                         ctx.instance.runtime_properties[AUTOSCALE_PROPERTY])
+
+    def test_static_autoscale(self):
+        ctx, bounds = self._autoscale(64, 1024 * 1024 * 1024,
+                                      autoscale='static')
+        self.assertEqual((2, 5), bounds)
+        self.assertNotIn(AUTOSCALE_PROPERTY, ctx.instance.runtime_properties)
+
+    def test_performance_configuration(self):
+        ctx = MockCloudifyContext(deployment_id='test')
+        config = {'distro': 'Ubuntu', 'distro_codename': 'trusty'}
+        conf = m(ctx, cloudify_agent=config)
+        self.assertEqual([None], list(set(conf['performance'].values())))
+        config = {'performance': {'pool': 'gevent',
+                                  'prefetch_multiplier': '1',
+                                  'acks_late': 'true'},
+                  'distro': 'Ubuntu',
+                  'distro_codename': 'trusty'}
+        conf = m(ctx, cloudify_agent=config)
+        self.assertEqual('gevent', conf['performance']['pool'])
+        self.assertEqual(1, conf['performance']['prefetch_multiplier'])
+        self.assertTrue(conf['performance']['acks_late'])
+        self.assertIsNone(conf['performance']['broker_heartbeat'])
+
+    def test_illegal_performance_configuration(self):
+        ctx = MockCloudifyContext(deployment_id='test')
+        for performance in [{'pool': 'threads'},
+                            {'max_tasks_per_child': 0},
+                            {'prefetch_multiplier': -1},
+                            {'broker_heartbeat': 'often'},
+                            {'acks_late': 'yes'},
+                            {'concurrency': 4},
+                            'fast']:
+            config = {'performance': performance,
+                      'distro': 'Ubuntu',
+                      'distro_codename': 'trusty'}
+            self.assertRaises(NonRecoverableError, m, ctx,
+                              cloudify_agent=config)
+
+    def test_unsupported_performance_configuration(self):
+        ctx = MockCloudifyContext(deployment_id='test')
+        config = {'performance': {'max_memory_per_child': 1024},
+                  'distro': 'Ubuntu',
+                  'distro_codename': 'trusty'}
+        self.assertRaisesRegexp(NonRecoverableError,
+                                'max_memory_per_child is not supported',
+                                m, ctx, cloudify_agent=config)
+
     def test_key_from_bootstrap_context(self):
         node_id = 'node_id'
         ctx = MockCloudifyContext(
@@ -452,10 +603,17 @@ class MockFabricRunner(FabricRunner):
 
     def __init__(self):
         self.put_files = {}
+        self.transfers = 0
 
     def put(self, file_path, content, use_sudo=False):
+        self.transfers += 1
         self.put_files[file_path] = content
 
+    def put_many(self, files):
+        self.transfers += 1
+        for file_path, content, _, _ in files:
+            self.put_files[file_path] = content
+
 
 class ConfigurationCreationTest(unittest.TestCase):
 
@@ -464,6 +622,8 @@ class ConfigurationCreationTest(unittest.TestCase):
         os.environ['MANAGER_REST_PORT'] = '8100'
         os.environ['MANAGEMENT_IP'] = '192.168.0.1'
         os.environ['AGENT_IP'] = '192.168.0.2'
+        template_cache.clear()
+        self.fetched_resources = []
 
     def read_file(self, file_name):
         file_path = path.join(path.dirname(__file__), file_name)
@@ -471,6 +631,7 @@ class ConfigurationCreationTest(unittest.TestCase):
             return f.read()
 
     def get_resource(self, resource_name):
+        self.fetched_resources.append(resource_name)
         if 'celeryd-cloudify.init' in resource_name:
             return self.read_file('Ubuntu-celeryd-cloudify.init.jinja2')
         elif 'celeryd-cloudify.conf' in resource_name:
@@ -486,6 +647,124 @@ class ConfigurationCreationTest(unittest.TestCase):
                                     agent_config,
                                     self.get_resource)
         self.assertEquals(3, len(runner.put_files))
+        self.assertEquals(1, runner.transfers)
         self.assertTrue(agent_config['init_file'] in runner.put_files)
         self.assertTrue(agent_config['config_file'] in runner.put_files)
         self.assertTrue(agent_config['includes_file'] in runner.put_files)
+
+    def test_performance_options_rendered(self):
+        ctx = MockCloudifyContext(deployment_id='deployment_id')
+        agent_config = m(ctx, cloudify_agent={
+            'performance': {'pool': 'eventlet',
+                            'max_tasks_per_child': 100,
+                            'prefetch_multiplier': 0,
+                            'broker_heartbeat': 10,
+                            'acks_late': False}})
+        runner = MockFabricRunner()
+        create_celery_configuration(ctx,
+                                    runner,
+                                    agent_config,
+                                    self.get_resource)
+        self.assertIn(
+            '--hostname=${WORKER_MODIFIER} --pool=eventlet '
+            '--maxtasksperchild=100 -- celeryd.prefetch_multiplier=0 '
+            'broker.heartbeat=10 celery.acks_late=false"',
+            runner.put_files[agent_config['config_file']])
+
+    def test_templates_cached(self):
+        for _ in range(3):
+            ctx = MockCloudifyContext(deployment_id='deployment_id')
+            agent_config = m(ctx)
+            runner = MockFabricRunner()
+            create_celery_configuration(ctx,
+                                        runner,
+                                        agent_config,
+                                        self.get_resource)
+            self.assertEquals(3, len(runner.put_files))
+        self.assertEquals(2, len(self.fetched_resources))
+
+    def test_template_cache_ttl(self):
+        cache = TemplateCache(ttl=10)
+        sources = {'template': 'first {{ value }}'}
+        resource_loader = MagicMock(side_effect=lambda path: sources[path])
+        template = cache.get_template(resource_loader, 'template')
+        self.assertEqual('first 1', template.render(value=1))
+
+        sources['template'] = 'second {{ value }}'
+        template = cache.get_template(resource_loader, 'template')
+        self.assertEqual('first 1', template.render(value=1))
+        self.assertEqual(1, resource_loader.call_count)
+
+        with patch('time.time', MagicMock(return_value=time.time() + 20)):
+            template = cache.get_template(resource_loader, 'template')
+        self.assertEqual('second 1', template.render(value=1))
+        self.assertEqual(2, resource_loader.call_count)
+
+
+class ConfigurationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bootstrap_context = MagicMock(cloudify_agent=MagicMock(
+            user='bootstrap_user', agent_key_path=KEY_FILE_PATH,
+            remote_execution_port=2222, min_workers=None, max_workers=None))
+
+    def _resolve(self, cache, agent_config, node_id='node'):
+        ctx = MockCloudifyContext(node_id=node_id,
+                                  deployment_id='deployment_id',
+                                  properties={'ip': '192.168.0.1'})
+        bootstrap_context = MagicMock(return_value=self.bootstrap_context)
+        with patch.object(MockCloudifyContext, 'bootstrap_context',
+                          property(bootstrap_context)), \
+                patch('os.path.isfile', MagicMock(return_value=True)) \
+                as isfile:
+            cache.resolve(ctx, agent_config)
+        return isfile.call_count
+
+    def test_resolved_once(self):
+        cache = ConfigurationCache()
+        config = {'distro': 'Ubuntu'}
+        self.assertNotEqual(0, self._resolve(cache, config))
+        self.assertEqual('bootstrap_user', config['user'])
+
+        cached = {'distro': 'Ubuntu'}
+        self.assertEqual(0, self._resolve(cache, cached))
+        self.assertEqual(config, cached)
+        cached['min_workers'] = 10
+        again = {'distro': 'Ubuntu'}
+        self.assertEqual(0, self._resolve(cache, again))
+        self.assertEqual(DEFAULT_MIN_WORKERS, again['min_workers'])
+
+    def test_changed_bootstrap_context(self):
+        cache = ConfigurationCache()
+        self._resolve(cache, {'distro': 'Ubuntu'})
+        self.bootstrap_context.cloudify_agent.user = 'other_user'
+        config = {'distro': 'Ubuntu'}
+        self.assertNotEqual(0, self._resolve(cache, config))
+        self.assertEqual('other_user', config['user'])
+
+    def test_resolved_again(self):
+        cache = ConfigurationCache(ttl=10)
+        self._resolve(cache, {'distro': 'Ubuntu'})
+        self.assertNotEqual(0, self._resolve(cache, {'distro': 'Debian'}))
+        self.assertNotEqual(0, self._resolve(cache, {'distro': 'Ubuntu'},
+                                             node_id='other_node'))
+        with patch('time.time', MagicMock(return_value=time.time() + 20)):
+            self.assertNotEqual(0, self._resolve(cache, {'distro': 'Ubuntu'}))
+
+    def test_expired_entries_dropped(self):
+        cache = ConfigurationCache(ttl=10)
+        self._resolve(cache, {'distro': 'Ubuntu'})
+        self._resolve(cache, {'distro': 'Ubuntu'}, node_id='other_node')
+        with patch('time.time', MagicMock(return_value=time.time() + 20)):
+            self._resolve(cache, {'distro': 'Debian'})
+        self.assertEqual(1, len(cache))
+
+    def test_max_size(self):
+        cache = ConfigurationCache(max_size=2)
+        for node_id in ['first', 'second', 'third']:
+            self._resolve(cache, {'distro': 'Ubuntu'}, node_id=node_id)
+        self.assertEqual(2, len(cache))
+        self.assertNotEqual(0, self._resolve(cache, {'distro': 'Ubuntu'},
+                                             node_id='first'))
+        self.assertEqual(0, self._resolve(cache, {'distro': 'Ubuntu'},
+                                          node_id='third'))
@@ -13,12 +13,23 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
+import os
+import json
+import shutil
+import tempfile
 import unittest
 
 from mock import patch
 from mock import MagicMock
 
 from worker_installer import init_worker_installer
+from worker_installer import HOST_FACTS_PROPERTY
+from worker_installer import HOST_FACTS_VERSION
+from worker_installer import configuration_cache
+from worker_installer import get_host_facts
+from worker_installer import agent_paths
+from worker_installer import _run_py_cmd_with_output
+from worker_installer.utils import ParamikoRunner
 from cloudify.mocks import MockCloudifyContext
 from cloudify.exceptions import NonRecoverableError
 
@@ -26,6 +37,23 @@ from cloudify.exceptions import NonRecoverableError
 # for tests purposes. need a path to a file which always exists
 KEY_FILE_PATH = '/bin/sh'
 
+HOST_FACTS = {
+    'distro': ['Ubuntu', '14.04', 'trusty'],
+    'home_dir': '/home/user',
+    'base_dir_exists': False,
+    'init_file_exists': False,
+    'config_file_exists': False,
+    'install_checkpoints': None,
+    'wget': True,
+    'curl': False,
+    'pigz': False,
+    'zstd': False,
+    'cpu_count': 4,
+    'memory_available': 1024 * 1024 * 1024,
+    'sudo': True,
+    'requiretty': False
+}
+
 
 @init_worker_installer
 def init_cloudify_agent_configuration(*args, **kwargs):
@@ -37,10 +65,130 @@ def init_cloudify_agent_configuration(*args, **kwargs):
         raise ValueError("'cloudify_agent' not set by init_worker_installer")
 
 
-@patch('worker_installer._run_py_cmd_with_output', MagicMock(return_value=""))
+@patch('worker_installer._run_py_cmd_with_output',
+       MagicMock(return_value=json.dumps(HOST_FACTS)))
 @patch('worker_installer.utils.FabricRunner', MagicMock())
 class InitTest(unittest.TestCase):
 
+    def setUp(self):
+        configuration_cache.clear()
+
+    def test_host_facts_gathered_once(self):
+        ctx = MockCloudifyContext(node_id='node_id',
+                                  properties={'ip': 'localhost'})
+        probe = MagicMock(return_value=json.dumps(HOST_FACTS))
+        with patch('worker_installer._run_py_cmd_with_output', probe):
+            cloudify_agent = init_cloudify_agent_configuration(
+                ctx,
+                cloudify_agent={'user': 'input_user',
+                                'key': KEY_FILE_PATH})
+        self.assertEqual(1, probe.call_count)
+        self.assertEqual('/home/user', cloudify_agent['home_dir'])
+        self.assertEqual('Ubuntu', cloudify_agent['distro'])
+        self.assertEqual('trusty', cloudify_agent['distro_codename'])
+
+    def test_host_facts_command_paths(self):
+        home_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home_dir)
+        os.makedirs(agent_paths(home_dir, 'agent')['base_dir'])
+        # evaluated in-process, as it is on a management worker
+        runner = MagicMock(local=True, host_facts=None)
+        with patch('worker_installer._run_py_cmd_with_output',
+                   _run_py_cmd_with_output):
+            facts = get_host_facts(runner, {'name': 'agent',
+                                            'home_dir': home_dir})
+        self.assertTrue(facts['base_dir_exists'])
+        self.assertEqual(home_dir, facts['home_dir'])
+
+    def test_timings_failure_keeps_operation_error(self):
+        @init_worker_installer
+        def failing(*args, **kwargs):
+            raise RuntimeError('operation failed')
+
+        ctx = MockCloudifyContext(node_id='node_id',
+                                  properties={'ip': 'localhost'})
+        with patch('worker_installer.report_timings',
+                   MagicMock(side_effect=IOError('no manager'))):
+            self.assertRaisesRegexp(
+                RuntimeError, 'operation failed', failing, ctx,
+                cloudify_agent={'user': 'input_user', 'key': KEY_FILE_PATH})
+
+    def test_paramiko_runner_without_passwordless_sudo(self):
+        runner = MagicMock(spec=ParamikoRunner)
+        runner.ctx = MagicMock()
+        facts = dict(HOST_FACTS, sudo=False)
+        with patch('worker_installer._run_py_cmd_with_output',
+                   MagicMock(return_value=json.dumps(facts))):
+            get_host_facts(runner, {'name': 'agent', 'user': 'user',
+                                    'host': 'host'})
+        self.assertIn('passwordless sudo',
+                      runner.ctx.logger.warning.call_args[0][0])
+
+    def _stored_facts_ctx(self, stamp):
+        stored = {
+            'distro': ['Ubuntu', '12.04', 'precise'],
+            'home_dir': '/home/stored',
+            'stamp': stamp
+        }
+        return MockCloudifyContext(
+            node_id='node_id',
+            properties={'ip': 'localhost'},
+            runtime_properties={HOST_FACTS_PROPERTY: stored})
+
+    def _init_with_probe(self, ctx, **config):
+        probe = MagicMock(return_value=json.dumps(HOST_FACTS))
+        config.update({'user': 'input_user', 'key': KEY_FILE_PATH})
+        with patch('worker_installer._run_py_cmd_with_output', probe):
+            cloudify_agent = init_cloudify_agent_configuration(
+                ctx, cloudify_agent=config)
+        return cloudify_agent, probe.call_count
+
+    def test_host_facts_stored(self):
+        ctx = MockCloudifyContext(node_id='node_id',
+                                  properties={'ip': 'localhost'})
+        self._init_with_probe(ctx)
+        stored = ctx.instance.runtime_properties[HOST_FACTS_PROPERTY]
+        self.assertEqual('/home/user', stored['home_dir'])
+        self.assertEqual({'version': HOST_FACTS_VERSION,
+                          'host': 'localhost',
+                          'user': 'input_user'}, stored['stamp'])
+
+        cloudify_agent, probes = self._init_with_probe(ctx)
+        self.assertEqual(0, probes)
+        self.assertEqual('/home/user', cloudify_agent['home_dir'])
+
+    def test_stored_host_facts_used(self):
+        ctx = self._stored_facts_ctx({'version': HOST_FACTS_VERSION,
+                                      'host': 'localhost',
+                                      'user': 'input_user'})
+        cloudify_agent, probes = self._init_with_probe(ctx)
+        self.assertEqual(0, probes)
+        self.assertEqual('/home/stored', cloudify_agent['home_dir'])
+        self.assertEqual('precise', cloudify_agent['distro_codename'])
+
+    def test_stored_host_facts_stamp_changed(self):
+        ctx = self._stored_facts_ctx({'version': HOST_FACTS_VERSION - 1,
+                                      'host': 'localhost',
+                                      'user': 'input_user'})
+        cloudify_agent, probes = self._init_with_probe(ctx)
+        self.assertEqual(1, probes)
+        self.assertEqual('/home/user', cloudify_agent['home_dir'])
+
+        ctx = self._stored_facts_ctx({'version': HOST_FACTS_VERSION,
+                                      'host': 'other_host',
+                                      'user': 'input_user'})
+        cloudify_agent, probes = self._init_with_probe(ctx)
+        self.assertEqual(1, probes)
+
+    def test_stored_host_facts_refresh(self):
+        ctx = self._stored_facts_ctx({'version': HOST_FACTS_VERSION,
+                                      'host': 'localhost',
+                                      'user': 'input_user'})
+        cloudify_agent, probes = self._init_with_probe(
+            ctx, refresh_host_facts=True)
+        self.assertEqual(1, probes)
+        self.assertEqual('/home/user', cloudify_agent['home_dir'])
+
     def test_cloudify_agent_config_duplication(self):
         ctx = MockCloudifyContext(node_id='node_id',
                                   properties={'cloudify_agent':
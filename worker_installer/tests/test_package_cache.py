@@ -0,0 +1,137 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from mock import patch
+
+from cloudify.mocks import MockCloudifyContext
+
+from worker_installer import package_cache
+from worker_installer.utils import FabricRunner
+from worker_installer.utils import FabricRunnerException
+
+
+class PackageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        os.makedirs(self.cache_dir)
+        # a deployment context makes the runner execute commands locally
+        ctx = MockCloudifyContext(deployment_id='deployment_id')
+        self.runner = FabricRunner(ctx)
+
+    def _package(self, name, content):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path, hashlib.sha256(content).hexdigest()
+
+    def _cache(self, content, mtime, extension='tar.gz'):
+        checksum = hashlib.sha256(content).hexdigest()
+        path = package_cache.cached_package_path(self.cache_dir, checksum,
+                                                 extension)
+        with open(path, 'w') as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_get_package_checksum(self):
+        path, checksum = self._package('agent.tar.gz', 'package')
+        url = 'file://{0}'.format(path)
+        self.assertEqual(checksum, package_cache.get_package_checksum(url))
+        with patch('worker_installer.package_cache.read_resource_chunks') \
+                as read:
+            self.assertEqual(checksum,
+                             package_cache.get_package_checksum(url))
+            self.assertFalse(read.called)
+
+        path, checksum = self._package('agent.tar.gz', 'changed package')
+        self.assertEqual(checksum, package_cache.get_package_checksum(url))
+
+    def test_published_checksum(self):
+        path, checksum = self._package('agent.tar.gz', 'package')
+        with open(path + package_cache.CHECKSUM_SUFFIX, 'w') as f:
+            f.write('{0}  agent.tar.gz\n'.format(checksum.upper()))
+        url = 'file://{0}'.format(path)
+        with patch('worker_installer.package_cache._get_validators') \
+                as validators:
+            self.assertEqual(checksum,
+                             package_cache.get_package_checksum(url))
+            self.assertFalse(validators.called)
+
+    def test_checksum_kept_without_validators(self):
+        path, checksum = self._package('unvalidated.tar.gz', 'package')
+        url = 'file://{0}'.format(path)
+        with patch('worker_installer.package_cache._get_validators',
+                   return_value=None):
+            self.assertEqual(checksum,
+                             package_cache.get_package_checksum(url))
+            with patch('worker_installer.package_cache.'
+                       'read_resource_chunks') as read:
+                self.assertEqual(checksum,
+                                 package_cache.get_package_checksum(url))
+            self.assertFalse(read.called)
+
+    def test_store_and_hit(self):
+        path, checksum = self._package('agent.tar.gz', 'package')
+        self.assertRaises(FabricRunnerException, self.runner.run,
+                          package_cache.cache_hit_command(self.cache_dir,
+                                                          checksum))
+        self.runner.run_with_input(
+            package_cache.store_command(self.cache_dir, checksum),
+            ['pack', 'age'])
+        self.runner.run(package_cache.cache_hit_command(self.cache_dir,
+                                                        checksum))
+
+    def test_store_corrupted_package(self):
+        path, checksum = self._package('agent.tar.gz', 'package')
+        self.assertRaises(FabricRunnerException, self.runner.run_with_input,
+                          package_cache.store_command(self.cache_dir,
+                                                      checksum),
+                          ['corrupted'])
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_evict(self):
+        now = time.time()
+        oldest = self._cache('a' * 100, now - 30)
+        older = self._cache('b' * 100, now - 20, 'tar.zst')
+        newest = self._cache('c' * 100, now - 10)
+        self.runner.run(package_cache.evict_command(
+            self.cache_dir, 250, oldest))
+        self.assertTrue(os.path.exists(oldest))
+        self.assertFalse(os.path.exists(older))
+        self.assertTrue(os.path.exists(newest))
+
+    def test_shared_cache(self):
+        self.assertIn('sudo chmod 777 /cache',
+                      package_cache.prepare_cache_dir_command('/cache'))
+        self.runner.run(
+            package_cache.prepare_cache_dir_command(self.cache_dir))
+        path, checksum = self._package('agent.tar.gz', 'package')
+        self.runner.run_with_input(
+            package_cache.store_command(self.cache_dir, checksum),
+            ['package'])
+        cached = package_cache.cached_package_path(self.cache_dir, checksum)
+        # agents of other users mark it as used by touching it
+        self.assertEqual(package_cache.PACKAGE_MODE,
+                         os.stat(cached).st_mode & 0777)
@@ -0,0 +1,247 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import time
+import unittest
+
+from mock import patch
+from mock import MagicMock
+
+from cloudify.mocks import MockCloudifyContext
+
+from worker_installer import tasks
+from worker_installer.utils import FabricRunnerException
+
+
+class MockEventReceiver(object):
+
+    def __init__(self, events):
+        self.events = events
+
+    def __call__(self, connection, worker_name, handlers):
+        self.handlers = handlers
+        return self
+
+    def itercapture(self, timeout=None):
+        for event in self.events:
+            self.handlers[event['type']](event)
+            yield
+
+
+@patch('worker_installer.tasks.celery_client', MagicMock())
+class WaitForStartedTest(unittest.TestCase):
+
+    def test_worker_online_event(self):
+        receiver = MockEventReceiver([
+            {'type': 'worker-heartbeat', 'hostname': 'celery@other'},
+            {'type': 'worker-online', 'hostname': 'celery@agent'}
+        ])
+        with patch('worker_installer.tasks.WorkerEventReceiver', receiver):
+            self.assertTrue(tasks._wait_for_worker_event(
+                'celery@agent', time.time() + 10))
+
+    def test_no_worker_event(self):
+        receiver = MockEventReceiver([
+            {'type': 'worker-heartbeat', 'hostname': 'celery@other'}
+        ])
+        with patch('worker_installer.tasks.WorkerEventReceiver', receiver):
+            self.assertFalse(tasks._wait_for_worker_event(
+                'celery@agent', time.time() + 10))
+
+    @patch('time.sleep')
+    def test_poll_worker_stats_backoff(self, sleep):
+        inspect = tasks.celery_client.control.inspect.return_value
+        inspect.stats.side_effect = [None, {}, {},
+                                     {'celery@agent': {'pid': 1}}]
+        self.assertTrue(tasks._poll_worker_stats(
+            'celery@agent', time.time() + 100, 1))
+        intervals = [round(c[0][0]) for c in sleep.call_args_list]
+        self.assertEqual([1, 2, 4], intervals)
+
+    @patch('worker_installer.tasks._verify_no_celery_error', MagicMock())
+    @patch('worker_installer.tasks._poll_worker_stats')
+    @patch('worker_installer.tasks.ctx', MagicMock())
+    def test_fallback_to_polling(self, poll):
+        agent_config = {
+            'name': 'agent',
+            'wait_started_timeout': 10,
+            'wait_started_interval': 1
+        }
+        with patch('worker_installer.tasks._wait_for_worker_event',
+                   MagicMock(side_effect=IOError('no broker'))):
+            tasks._wait_for_started(MagicMock(), agent_config)
+        self.assertEqual('celery@agent', poll.call_args[0][0])
+
+    @patch('worker_installer.tasks._verify_no_celery_error', MagicMock())
+    @patch('worker_installer.tasks.ctx', MagicMock())
+    @patch('worker_installer.tasks._wait_for_worker_event',
+           MagicMock(return_value=False))
+    def test_stats_polled_without_events(self):
+        inspect = tasks.celery_client.control.inspect.return_value
+        inspect.stats.side_effect = None
+        inspect.stats.return_value = {'celery@agent': {'pid': 1}}
+        agent_config = {
+            'name': 'agent',
+            'wait_started_timeout': 0,
+            'wait_started_interval': 1
+        }
+        tasks._wait_for_started(MagicMock(), agent_config)
+        self.assertTrue(inspect.stats.called)
+
+
+def _batch_runner(codes):
+    def run_batch(commands):
+        for command, code in zip(commands, codes):
+            command.code = code
+            command.output = ''
+        return commands
+    runner = MagicMock()
+    runner.run_batch.side_effect = run_batch
+    return runner
+
+
+class DeleteIfExistTest(unittest.TestCase):
+
+    def test_delete_if_exist(self):
+        runner = _batch_runner([0, tasks.MISSING_PATH_CODE, 0])
+        missing = tasks.delete_if_exist(MagicMock(), {'name': 'agent'},
+                                        runner, ['/init', '/config'],
+                                        ['/base_dir'])
+        self.assertEqual(['/config'], missing)
+        self.assertEqual(1, runner.run_batch.call_count)
+        commands = runner.run_batch.call_args[0][0]
+        self.assertIn('sudo rm /init', commands[0].command)
+        self.assertIn('sudo rm -rf /base_dir', commands[2].command)
+
+    def test_delete_if_exist_failure(self):
+        runner = _batch_runner([0, 1])
+        self.assertRaises(FabricRunnerException, tasks.delete_if_exist,
+                          MagicMock(), {'name': 'agent'}, runner,
+                          ['/init'], ['/base_dir'])
+
+
+@patch('worker_installer.tasks.celery_client')
+@patch('worker_installer.tasks.create_runner')
+@patch('worker_installer.tasks.get_agent_configuration',
+       MagicMock(return_value={'name': 'agent'}))
+class StatusTest(unittest.TestCase):
+
+    def _status(self, create_runner, celery_client, replies, code=None):
+        inspect = celery_client.control.inspect.return_value
+        inspect.ping.return_value = replies
+        runner = _batch_runner([code])
+        create_runner.return_value = runner
+        alive = tasks.status(ctx=MockCloudifyContext(node_id='agent'))
+        return alive, runner
+
+    def test_alive(self, create_runner, celery_client):
+        alive, runner = self._status(
+            create_runner, celery_client, {'celery@agent': {'ok': 'pong'}})
+        self.assertTrue(alive)
+        self.assertFalse(create_runner.called)
+        self.assertEqual(['celery@agent'],
+                         celery_client.control.inspect.call_args[1][
+                             'destination'])
+
+    def test_service_running(self, create_runner, celery_client):
+        alive, runner = self._status(create_runner, celery_client, None, 0)
+        self.assertTrue(alive)
+        command = runner.run_batch.call_args[0][0][0]
+        self.assertEqual('sudo service celeryd-agent status',
+                         command.command)
+        self.assertTrue(runner.close.called)
+
+    def test_not_running(self, create_runner, celery_client):
+        celery_client.control.inspect.return_value.ping.side_effect = \
+            IOError('broker down')
+        alive, runner = self._status(create_runner, celery_client, None, 3)
+        self.assertFalse(alive)
+        self.assertEqual(1, runner.run_batch.call_count)
+
+
+@patch('worker_installer.tasks.get_agent_resource_url',
+       MagicMock(return_value='http://manager/agent.tar.gz'))
+class InstallResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.agent_config = {
+            'name': 'agent',
+            'user': 'user',
+            'base_dir': '/home/user/cloudify.agent',
+            'includes_file': '/home/user/cloudify.agent/work/includes',
+            'config_file': '/etc/default/celeryd-agent',
+            'init_file': '/etc/init.d/celeryd-agent',
+            'disable_requiretty': False,
+            'delete_amqp_queues': False,
+            'agent_package_compression': 'gzip',
+            'relocate_agent_package': False,
+            'stream_agent_package': False,
+            'package_cache': False,
+            'autoscale': 'static'
+        }
+        patcher = patch('worker_installer.tasks.create_celery_configuration')
+        self.create_celery_configuration = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _install(self, checkpoints, base_dir_exists=True):
+        runner = MagicMock()
+        runner.host_facts = {'base_dir_exists': base_dir_exists,
+                             'install_checkpoints': checkpoints}
+        tasks.install_agent(MagicMock(), runner, self.agent_config)
+        return runner
+
+    def _checkpoint(self, checkpoint):
+        return 'touch /home/user/cloudify.agent/.install-checkpoints/{0}'\
+            .format(checkpoint)
+
+    def _batches(self, runner):
+        return [[command.command for command in c[0][0]]
+                for c in runner.run_batch.call_args_list]
+
+    def test_install(self):
+        runner = self._install(None, base_dir_exists=False)
+        package, rest = self._batches(runner)
+        self.assertEqual(
+            'mkdir -p /home/user/cloudify.agent/.install-checkpoints',
+            package[0])
+        self.assertEqual(self._checkpoint('package'), package[-1])
+        self.assertEqual(
+            'configuration',
+            self.create_celery_configuration.call_args[1]['checkpoint'])
+        self.assertEqual(self._checkpoint('installed'), rest[-1])
+        self.assertFalse(runner.run.called)
+
+    def test_resume_after_package(self):
+        runner = self._install(['package'])
+        rest, = self._batches(runner)
+        self.assertEqual(self._checkpoint('installed'), rest[-1])
+        runner.run.assert_called_once_with(
+            'sudo rm -f /home/user/cloudify.agent/work/includes '
+            '/etc/default/celeryd-agent /etc/init.d/celeryd-agent')
+        self.assertTrue(self.create_celery_configuration.called)
+
+    def test_resume_after_configuration(self):
+        runner = self._install(['configuration', 'package'])
+        rest, = self._batches(runner)
+        self.assertIn('rm -f /home/user/cloudify.agent/agent.tar.gz', rest)
+        self.assertEqual(self._checkpoint('installed'), rest[-1])
+        self.assertFalse(self.create_celery_configuration.called)
+
+    def test_installed(self):
+        for checkpoints in [['configuration', 'installed', 'package'],
+                            None]:
+            runner = self._install(checkpoints)
+            self.assertFalse(runner.run_batch.called)
+            self.assertFalse(self.create_celery_configuration.called)
@@ -0,0 +1,67 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import unittest
+
+from cloudify.mocks import MockCloudifyContext
+
+from worker_installer.timing import OperationTimer
+from worker_installer.timing import TIMINGS_PROPERTY
+from worker_installer.timing import report_timings
+from worker_installer.utils import FabricRunner
+
+
+class OperationTimerTest(unittest.TestCase):
+
+    def test_phases_accumulate(self):
+        timer = OperationTimer()
+        with timer.phase('download'):
+            pass
+        timer.add_phase('download', 1.5)
+        timer.add_phase('extract', 0.25)
+        summary = timer.summary()
+        self.assertEqual(1.5, summary['phases']['download'])
+        self.assertEqual(0.25, summary['phases']['extract'])
+
+    def test_nested_calls_counted_once(self):
+        timer = OperationTimer()
+        for _ in range(2):
+            with timer.call('put'):
+                with timer.call('run_with_input'):
+                    pass
+        self.assertEqual({'put': 2}, dict(
+            (method, call['count'])
+            for method, call in timer.summary()['calls'].items()))
+
+    def test_runner_calls_timed(self):
+        ctx = MockCloudifyContext(deployment_id='deployment_id')
+        runner = FabricRunner(ctx)
+        runner.run('true')
+        runner.exists('/')
+        runner.exists('/')
+        calls = runner.timer.summary()['calls']
+        self.assertEqual(1, calls['run']['count'])
+        self.assertEqual(2, calls['exists']['count'])
+
+    def test_report_timings(self):
+        ctx = MockCloudifyContext(node_id='node_id',
+                                  runtime_properties={})
+        timer = OperationTimer()
+        timer.add_phase('start', 2)
+        report_timings(ctx, timer, 'install')
+        report_timings(ctx, OperationTimer(), 'start')
+        timings = ctx.instance.runtime_properties[TIMINGS_PROPERTY]
+        self.assertEqual(['install', 'start'], sorted(timings.keys()))
+        self.assertEqual({'start': 2}, timings['install']['phases'])
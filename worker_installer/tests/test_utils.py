@@ -0,0 +1,614 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import shutil
+import socket
+import tempfile
+import tarfile
+import threading
+import unittest
+from StringIO import StringIO
+
+from mock import patch
+from mock import MagicMock
+from fabric.api import env
+from fabric.state import connections
+
+from cloudify.mocks import MockCloudifyContext
+from cloudify.exceptions import NonRecoverableError
+
+from worker_installer import utils
+from worker_installer.utils import FabricRunner
+from worker_installer.utils import ConnectionPool
+from worker_installer.utils import BatchCommand
+from worker_installer.utils import FabricRunnerException
+from worker_installer.utils import ParamikoRunner
+from worker_installer.utils import create_runner
+from worker_installer.utils import read_resource_chunks
+from worker_installer.tests.stand_ins import InProcessSSHServer
+from worker_installer.tests.stand_ins import SimulatedRunner
+
+
+class MockSSHServer(object):
+    """
+    Stands in for an sshd, counts the connections fabric opens to it.
+    """
+
+    def __init__(self):
+        self.connections = []
+
+    def connect(self, user, host, port, *args, **kwargs):
+        client = MagicMock()
+        client.get_transport.return_value.is_active.return_value = True
+        self.connections.append(client)
+        return client
+
+    def run(self, command, **kwargs):
+        # fabric's run fetches the connection from the cache and so
+        # connects on first use
+        connections[env.host_string]
+        return ''
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockSSHServer()
+        self.pool = ConnectionPool(idle_timeout=60,
+                                   max_connections_per_host=2,
+                                   health_check_timeout=0.1)
+        patches = [
+            patch('fabric.network.connect', self.server.connect),
+            patch('worker_installer.utils.run', self.server.run),
+            patch('worker_installer.utils.connection_pool', self.pool)
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(self.pool.evict_all)
+
+    def _runner(self, user='user', host='10.0.0.5', port=22, key='key'):
+        ctx = MockCloudifyContext(node_id='node_id')
+        return FabricRunner(ctx, {'user': user,
+                                  'host': host,
+                                  'port': port,
+                                  'key': key})
+
+    def _operation(self, runner):
+        try:
+            runner.ping()
+            runner.run('ls')
+        finally:
+            runner.close()
+
+    def test_connection_reused_across_operations(self):
+        self._operation(self._runner())
+        self._operation(self._runner())
+        self._operation(self._runner())
+        self.assertEqual(1, len(self.server.connections))
+
+    def test_idle_connection_evicted(self):
+        self._operation(self._runner())
+        with patch('time.time', MagicMock(return_value=utils.time.time() +
+                                          120)):
+            self._operation(self._runner())
+        self.assertEqual(2, len(self.server.connections))
+        self.server.connections[0].close.assert_called_once_with()
+
+    def test_unhealthy_connection_evicted(self):
+        self._operation(self._runner())
+        transport = self.server.connections[0].get_transport.return_value
+        transport.is_active.return_value = False
+        self._operation(self._runner())
+        self.assertEqual(2, len(self.server.connections))
+
+    def test_unresponsive_connection_evicted(self):
+        self._operation(self._runner())
+        transport = self.server.connections[0].get_transport.return_value
+        # the connection is still active locally, but the server is gone
+        unanswered = threading.Event()
+        self.addCleanup(unanswered.set)
+        transport.open_session.side_effect = unanswered.wait
+        self._operation(self._runner())
+        self.assertEqual(2, len(self.server.connections))
+        self.server.connections[0].close.assert_called_once_with()
+
+    def test_refused_session_evicts_connection(self):
+        self._operation(self._runner())
+        transport = self.server.connections[0].get_transport.return_value
+        transport.open_session.side_effect = EOFError()
+        self._operation(self._runner())
+        self.assertEqual(2, len(self.server.connections))
+
+    def test_health_check_session_closed(self):
+        self._operation(self._runner())
+        self._operation(self._runner())
+        transport = self.server.connections[0].get_transport.return_value
+        transport.open_session.return_value.close.assert_called_once_with()
+
+    def test_changed_credentials_reconnect(self):
+        self._operation(self._runner(key='key'))
+        self._operation(self._runner(key='other_key'))
+        self.assertEqual(2, len(self.server.connections))
+
+    def test_max_connections_per_host(self):
+        self._operation(self._runner(user='user1'))
+        self._operation(self._runner(user='user2'))
+        self._operation(self._runner(user='user3'))
+        self.assertEqual(3, len(self.server.connections))
+        # least recently used connection was closed to make room
+        self.server.connections[0].close.assert_called_once_with()
+        self.assertFalse(self.server.connections[2].close.called)
+        # other hosts are not affected by the limit
+        self._operation(self._runner(user='user1', host='10.0.0.6'))
+        self.assertFalse(self.server.connections[1].close.called)
+
+
+class RunBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        # a deployment context makes the runner execute commands locally
+        ctx = MockCloudifyContext(deployment_id='deployment_id')
+        self.runner = FabricRunner(ctx)
+
+    def test_run_batch(self):
+        commands = self.runner.run_batch([
+            BatchCommand('echo first'),
+            BatchCommand('echo second; echo "$HOME" > /dev/null')
+        ])
+        self.assertEqual([0, 0], [c.code for c in commands])
+        self.assertEqual(['first', 'second'], [c.output for c in commands])
+
+    def test_run_batch_phases(self):
+        commands = self.runner.run_batch([
+            BatchCommand('sleep 0.1', phase='download'),
+            BatchCommand('true', phase='download'),
+            BatchCommand('true')
+        ])
+        self.assertTrue(commands[0].duration >= 0.1)
+        self.assertEqual(
+            commands[0].duration + commands[1].duration,
+            self.runner.timer.phases['download'])
+
+    def test_run_batch_ignore_errors(self):
+        commands = self.runner.run_batch([
+            BatchCommand('echo failed; false', ignore_errors=True),
+            BatchCommand('echo passed')
+        ])
+        self.assertTrue(commands[0].failed)
+        self.assertEqual('failed', commands[0].output)
+        self.assertEqual(0, commands[1].code)
+
+    def test_run_batch_stops_on_error(self):
+        commands = [
+            BatchCommand('echo before'),
+            BatchCommand('echo error; exit 3'),
+            BatchCommand('echo after')
+        ]
+        with self.assertRaises(FabricRunnerException) as cm:
+            self.runner.run_batch(commands)
+        self.assertEqual(3, cm.exception.code)
+        self.assertEqual('error', cm.exception.message)
+        self.assertEqual(0, commands[0].code)
+        self.assertIsNone(commands[2].code)
+        self.assertIsNone(commands[2].output)
+
+    def test_run_batch_natively(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        directory = os.path.join(temp_dir, 'a', 'b')
+        link = os.path.join(temp_dir, 'link')
+        os.symlink('/nowhere', link)
+        with patch.object(self.runner, 'run',
+                          wraps=self.runner.run) as run:
+            commands = self.runner.run_batch([
+                utils.mkdir_command(directory),
+                utils.touch_command(os.path.join(directory, 'file')),
+                BatchCommand('echo shell'),
+                BatchCommand('echo shell again'),
+                utils.symlink_command(link, directory, phase='links'),
+                utils.remove_command(os.path.join(temp_dir, 'missing'))
+            ])
+        self.assertEqual(1, run.call_count)
+        self.assertEqual([0] * 6, [c.code for c in commands])
+        self.assertEqual('shell again', commands[3].output)
+        self.assertTrue(os.path.isfile(os.path.join(link, 'file')))
+        self.assertIn('links', self.runner.timer.phases)
+
+    def test_run_batch_natively_stops_on_error(self):
+        missing = os.path.join(tempfile.gettempdir(), 'missing-link')
+        commands = [
+            utils.symlink_command(missing, '/nowhere', ignore_errors=True),
+            utils.symlink_command(missing, '/nowhere'),
+            BatchCommand('echo after')
+        ]
+        self.assertRaises(FabricRunnerException,
+                          self.runner.run_batch, commands)
+        self.assertEqual([1, 1, None], [c.code for c in commands])
+
+
+class DownloadResourceCommandTest(unittest.TestCase):
+
+    def test_tool_from_host_facts(self):
+        self.assertEqual(
+            'wget -T 30 http://manager/r -O /tmp/r',
+            utils.download_resource_command('http://manager/r', '/tmp/r',
+                                            {'wget': True, 'curl': True}))
+        self.assertEqual(
+            'curl http://manager/r -o /tmp/r',
+            utils.download_resource_command('http://manager/r', '/tmp/r',
+                                            {'wget': False, 'curl': True}))
+        self.assertRaises(NonRecoverableError,
+                          utils.download_resource_command,
+                          'http://manager/r', '/tmp/r',
+                          {'wget': False, 'curl': False})
+
+    def test_tool_looked_for(self):
+        command = utils.download_resource_command('http://manager/r',
+                                                  '/tmp/r')
+        self.assertIn('which wget', command)
+        self.assertIn('which curl', command)
+
+
+def _tar_gz(files):
+    buf = StringIO()
+    tar = tarfile.open(fileobj=buf, mode='w:gz')
+    for name, content in files.items():
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, StringIO(content))
+    tar.close()
+    return buf.getvalue()
+
+
+class RunWithInputTest(unittest.TestCase):
+
+    def setUp(self):
+        ctx = MockCloudifyContext(deployment_id='deployment_id')
+        self.runner = FabricRunner(ctx)
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    def test_stream_package_into_tar(self):
+        package = os.path.join(self.temp_dir, 'agent.tar.gz')
+        with open(package, 'wb') as f:
+            f.write(_tar_gz({'agent/env/bin/python': 'python',
+                             'agent/env/lib/module.py': 'module'}))
+        target = os.path.join(self.temp_dir, 'agent')
+        self.runner.run_with_input(
+            'mkdir -p {0} && tar xzf - --strip=1 -C {0}'.format(target),
+            read_resource_chunks('file://{0}'.format(package),
+                                 chunk_size=16))
+        with open(os.path.join(target, 'env', 'lib', 'module.py')) as f:
+            self.assertEqual('module', f.read())
+
+    def test_failed_command(self):
+        with self.assertRaises(FabricRunnerException) as cm:
+            self.runner.run_with_input('cat > /dev/null; exit 5', ['data'])
+        self.assertEqual(5, cm.exception.code)
+
+
+class ReadResourceChunksTest(unittest.TestCase):
+
+    def test_stalled_file_server(self):
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        # connections are accepted by the kernel, but never answered
+        server.listen(1)
+        url = 'http://127.0.0.1:{0}/agent.tar.gz'.format(
+            server.getsockname()[1])
+        self.assertRaises(socket.timeout, list,
+                          read_resource_chunks(url, timeout=0.1))
+
+
+class PutGetTest(unittest.TestCase):
+
+    def setUp(self):
+        ctx = MockCloudifyContext(deployment_id='deployment_id')
+        self.runner = FabricRunner(ctx)
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        # sudo may be missing here, a shim runs commands as the current user
+        bin_dir = os.path.join(self.temp_dir, 'bin')
+        os.mkdir(bin_dir)
+        with open(os.path.join(bin_dir, 'sudo'), 'w') as f:
+            f.write('#!/bin/sh\nexec "$@"\n')
+        os.chmod(os.path.join(bin_dir, 'sudo'), 0755)
+        path = patch.dict(os.environ, {'PATH': '{0}:{1}'.format(
+            bin_dir, os.environ['PATH'])})
+        path.start()
+        self.addCleanup(path.stop)
+
+    def test_put_file_object(self):
+        file_path = os.path.join(self.temp_dir, 'work', 'file')
+        content = 'x' * (3 * utils.DEFAULT_CHUNK_SIZE + 5)
+        self.runner.put(file_path, StringIO(content))
+        with open(file_path) as f:
+            self.assertEqual(content, f.read())
+        self.assertRaises(NonRecoverableError,
+                          self.runner.put, file_path, 'other')
+        with open(file_path) as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual(['file'], os.listdir(os.path.dirname(file_path)))
+
+    def test_put_with_sudo(self):
+        file_path = os.path.join(self.temp_dir, 'work', 'file')
+        self.runner.put(file_path, 'content', use_sudo=True)
+        self.assertRaises(NonRecoverableError, self.runner.put,
+                          file_path, 'content', use_sudo=True)
+        self.assertEqual('content', self.runner.get(file_path))
+        self.assertEqual(['file'], os.listdir(os.path.dirname(file_path)))
+
+    def test_put_many(self):
+        includes = os.path.join(self.temp_dir, 'work', 'includes')
+        init = os.path.join(self.temp_dir, 'init.d', 'celeryd')
+        self.runner.put_many([
+            (includes, 'INCLUDES=a,b\n', None, False),
+            (init, StringIO(u'#!/bin/sh\n'), 0755, True)
+        ])
+        with open(includes) as f:
+            self.assertEqual('INCLUDES=a,b\n', f.read())
+        with open(init) as f:
+            self.assertEqual('#!/bin/sh\n', f.read())
+        self.assertEqual(0755, os.stat(init).st_mode & 0777)
+        self.assertEqual(['celeryd'], os.listdir(os.path.dirname(init)))
+
+    def test_put_many_refuses_existing_file(self):
+        existing = os.path.join(self.temp_dir, 'existing')
+        new = os.path.join(self.temp_dir, 'new')
+        with open(existing, 'w') as f:
+            f.write('existing')
+        self.assertRaises(NonRecoverableError, self.runner.put_many, [
+            (new, 'new', None, False),
+            (existing, 'other', None, True)
+        ])
+        self.assertFalse(os.path.exists(new))
+        with open(existing) as f:
+            self.assertEqual('existing', f.read())
+
+    def test_put_command(self):
+        file_path = os.path.join(self.temp_dir, 'work dir', 'file')
+        self.runner.run_with_input(utils.put_command(file_path),
+                                   iter(['first ', 'second']))
+        with open(file_path) as f:
+            self.assertEqual('first second', f.read())
+        with self.assertRaises(FabricRunnerException) as cm:
+            self.runner.run_with_input(utils.put_command(file_path),
+                                       ['other'])
+        self.assertEqual(utils.PUT_FILE_EXISTS_CODE, cm.exception.code)
+        self.assertEqual(['file'], os.listdir(os.path.dirname(file_path)))
+
+    def test_put_command_truncated(self):
+        file_path = os.path.join(self.temp_dir, 'work', 'file')
+        # as if the connection dropped after the first chunk
+        with self.assertRaises(FabricRunnerException) as cm:
+            self.runner.run_with_input(
+                utils.put_command(file_path, size=len('first second')),
+                ['first '])
+        self.assertIn('truncated', cm.exception.message)
+        self.assertEqual([], os.listdir(os.path.dirname(file_path)))
+        self.runner.run_with_input(
+            utils.put_command(file_path, size=len('first second')),
+            ['first ', 'second'])
+        with open(file_path) as f:
+            self.assertEqual('first second', f.read())
+
+    def test_get_into_sink(self):
+        file_path = os.path.join(self.temp_dir, 'file')
+        with open(file_path, 'w') as f:
+            f.write('content\n')
+        with patch('worker_installer.utils.DEFAULT_CHUNK_SIZE', 2):
+            sink = StringIO()
+            self.assertIs(sink, self.runner.get(file_path, sink))
+        self.assertEqual('content\n', sink.getvalue())
+
+
+class ParamikoRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = InProcessSSHServer()
+        self.addCleanup(self.server.close)
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        ctx = MockCloudifyContext(node_id='node_id')
+        self.runner = create_runner(ctx, {
+            'runner': 'paramiko',
+            'user': InProcessSSHServer.USER,
+            'password': InProcessSSHServer.PASSWORD,
+            'host': '127.0.0.1',
+            'port': self.server.port
+        })
+        self.addCleanup(self.runner.close)
+
+    def test_create_runner(self):
+        self.assertIsInstance(self.runner, ParamikoRunner)
+        ctx = MockCloudifyContext(node_id='node_id')
+        self.assertRaises(NonRecoverableError, create_runner, ctx,
+                          {'runner': 'telnet'})
+        # only tests and benchmarks simulate a network
+        self.assertRaises(NonRecoverableError, create_runner, ctx,
+                          {'runner': 'simulated'})
+
+    def test_run(self):
+        self.runner.ping()
+        self.assertEqual('hello', self.runner.run('echo hello'))
+        with self.assertRaises(FabricRunnerException) as cm:
+            self.runner.run('echo failed; exit 2')
+        self.assertEqual(2, cm.exception.code)
+        self.assertEqual('failed', cm.exception.message)
+
+    def test_run_batch(self):
+        commands = self.runner.run_batch([
+            BatchCommand('echo first'),
+            BatchCommand('echo second')
+        ])
+        self.assertEqual(['first', 'second'], [c.output for c in commands])
+        self.assertEqual(1, len(self.server.commands))
+
+    def test_run_with_input(self):
+        file_path = os.path.join(self.temp_dir, 'file')
+        self.runner.run_with_input('cat > {0}'.format(file_path),
+                                   iter(['first ', 'second']))
+        with open(file_path) as f:
+            self.assertEqual('first second', f.read())
+
+    def test_run_with_failing_input(self):
+        def chunks():
+            yield 'first '
+            raise socket.timeout('timed out')
+
+        file_path = os.path.join(self.temp_dir, 'file')
+        self.assertRaises(socket.timeout, self.runner.run_with_input,
+                          'cat > {0}'.format(file_path), chunks())
+        # the command got its end of input and the connection still works
+        self.assertEqual('first', self.runner.run('cat {0}'.format(
+            file_path)))
+
+    def test_put_get_exists(self):
+        file_path = os.path.join(self.temp_dir, 'work', 'file')
+        self.assertFalse(self.runner.exists(file_path))
+        self.runner.put(file_path, 'content\nwith lines\n')
+        self.assertTrue(self.runner.exists(file_path))
+        self.assertEqual('content\nwith lines\n', self.runner.get(file_path))
+        self.assertRaises(NonRecoverableError,
+                          self.runner.put, file_path, 'content')
+        sink = StringIO()
+        self.runner.get(file_path, sink)
+        self.assertEqual('content\nwith lines\n', sink.getvalue())
+
+    def test_put_single_command(self):
+        file_path = os.path.join(self.temp_dir, 'file')
+        self.runner.host_facts = {'requiretty': False}
+        self.runner.put(file_path, StringIO('content'))
+        self.assertEqual(1, len(self.server.commands))
+        with open(file_path) as f:
+            self.assertEqual('content', f.read())
+
+    def test_put_with_sudo_requiring_tty(self):
+        file_path = os.path.join(self.temp_dir, 'file')
+        self.runner.host_facts = {'requiretty': True}
+        # the host has no sudo, the commands are only checked to run
+        with patch('worker_installer.utils._sudo_command', lambda c: c):
+            self.runner.put(file_path, 'content', use_sudo=True)
+            self.assertRaises(NonRecoverableError, self.runner.put,
+                              file_path, 'content', use_sudo=True)
+        self.assertEqual(4, len(self.server.commands))
+        self.assertEqual(['file'], os.listdir(self.temp_dir))
+        with open(file_path) as f:
+            self.assertEqual('content', f.read())
+
+    def test_put_many_with_sudo_requiring_tty(self):
+        first = os.path.join(self.temp_dir, 'first')
+        second = os.path.join(self.temp_dir, 'work', 'second')
+        self.runner.host_facts = {'requiretty': True}
+        with patch('worker_installer.utils._sudo_command', lambda c: c):
+            self.runner.put_many([(first, 'first', None, False),
+                                  (second, 'second', 0600, True)])
+        self.assertEqual(2, len(self.server.commands))
+        with open(second) as f:
+            self.assertEqual('second', f.read())
+        self.assertEqual(0600, os.stat(second).st_mode & 0777)
+
+    def test_concurrent_runners(self):
+        ctx = MockCloudifyContext(node_id='node_id')
+        outputs = {}
+
+        def run(index):
+            runner = ParamikoRunner(ctx, {
+                'user': InProcessSSHServer.USER,
+                'password': InProcessSSHServer.PASSWORD,
+                'host': '127.0.0.1',
+                'port': self.server.port
+            })
+            try:
+                outputs[index] = runner.run('echo {0}'.format(index))
+            finally:
+                runner.close()
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(dict((i, str(i)) for i in range(5)), outputs)
+
+
+class SimulatedRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        patches = [
+            patch('time.sleep', self.sleeps.append),
+            patch.dict(utils.RUNNERS, simulated=SimulatedRunner)
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _runner(self, **simulation):
+        # a deployment context makes the simulated runner execute locally
+        ctx = MockCloudifyContext(deployment_id='deployment_id')
+        return create_runner(ctx, {'runner': 'simulated',
+                                   'simulation': simulation})
+
+    def test_latency_and_trace(self):
+        runner = self._runner(latency=0.1)
+        self.assertIsInstance(runner, SimulatedRunner)
+        self.assertEqual('hello', runner.run('echo hello'))
+        runner.run_batch([BatchCommand('true'), BatchCommand('true')])
+        runner.run_with_input('cat > /dev/null', ['data'])
+        self.assertEqual([0.1, 0.1, 0.1], self.sleeps)
+        self.assertEqual(['run', 'run', 'run_with_input'],
+                         [entry['method'] for entry in runner.trace])
+        self.assertEqual(len('echo hello'), runner.trace[0]['sent'])
+        self.assertEqual(len('hello'), runner.trace[0]['received'])
+        self.assertEqual(len('cat > /dev/null') + 4,
+                         runner.trace[2]['sent'])
+
+    def test_bandwidth(self):
+        runner = self._runner(bandwidth=10)
+        runner.run_with_input('cat', ['0123456789'])
+        # command, input chunk and output
+        self.assertEqual([0.3, 0, 1.0, 1.0], self.sleeps)
+
+    def test_failure_rate(self):
+        runner = self._runner(failure_rate=0.5, seed=1)
+        outcomes = []
+        for _ in range(20):
+            try:
+                runner.run('true')
+                outcomes.append(True)
+            except FabricRunnerException as e:
+                self.assertEqual(-1, e.code)
+                outcomes.append(False)
+        self.assertIn(True, outcomes)
+        self.assertIn(False, outcomes)
+        self.assertEqual([not o for o in outcomes],
+                         [entry['failed'] for entry in runner.trace])
+        # the same seed fails the same round-trips
+        again = self._runner(failure_rate=0.5, seed=1)
+        for _ in range(20):
+            try:
+                again.run('true')
+            except FabricRunnerException:
+                pass
+        self.assertEqual([entry['failed'] for entry in runner.trace],
+                         [entry['failed'] for entry in again.trace])
+
+    def test_cannot_simulate_itself(self):
+        self.assertRaises(NonRecoverableError, self._runner,
+                          runner='simulated')
@@ -0,0 +1,109 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import json
+import time
+from functools import wraps
+from contextlib import contextmanager
+
+from cloudify import context
+
+TIMINGS_PROPERTY = 'cloudify_agent_timings'
+
+
+class OperationTimer(object):
+    """
+    Collects the timing spans of a single operation.
+
+    Phases are named spans of the operation (connect, download, start...),
+    a phase entered more than once accumulates its durations and phases
+    may nest. Calls count and time the runner's remote calls, a call made
+    from within another call is accounted to the outer one.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.calls = {}
+        self._call_depth = 0
+
+    @contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.time() - started)
+
+    def add_phase(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0) + duration
+
+    @contextmanager
+    def call(self, method):
+        if self._call_depth:
+            yield
+            return
+        self._call_depth += 1
+        started = time.time()
+        try:
+            yield
+        finally:
+            self._call_depth -= 1
+            count, duration = self.calls.get(method, (0, 0))
+            self.calls[method] = (count + 1,
+                                  duration + time.time() - started)
+
+    def summary(self):
+        return {
+            'total': round(time.time() - self.started, 3),
+            'phases': dict((name, round(duration, 3))
+                           for name, duration in self.phases.items()),
+            'calls': dict((method, {'count': count,
+                                    'duration': round(duration, 3)})
+                          for method, (count, duration)
+                          in self.calls.items())
+        }
+
+
+def timed(func):
+    """counts and times calls to a runner method"""
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.timer.call(func.__name__):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+def report_timings(ctx, timer, operation):
+    """sends an operation's timing summary as an event
+
+    The summary is also stored in the node instance's runtime properties,
+    by operation name.
+    """
+    summary = timer.summary()
+    message = 'Cloudify agent {0} timings: {1}'.format(
+        operation, json.dumps(summary, sort_keys=True))
+    ctx.logger.debug(message)
+    if ctx.type == context.NODE_INSTANCE:
+        timings = dict(
+            ctx.instance.runtime_properties.get(TIMINGS_PROPERTY) or {})
+        timings[operation] = summary
+        ctx.instance.runtime_properties[TIMINGS_PROPERTY] = timings
+    try:
+        ctx.send_event(message)
+    except Exception as e:
+        ctx.logger.debug('Failed sending timings event: {0}'.format(str(e)))
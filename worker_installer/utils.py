@@ -15,17 +15,32 @@
 
 
 import os
+import time
+import uuid
+import errno
+import pipes
+import socket
+import urllib2
+import tarfile
 import tempfile
+import threading
+import subprocess
 from StringIO import StringIO
+from contextlib import contextmanager
 
-import fabric.network
-from fabric.api import run, put, get, local, sudo
+import paramiko
+from fabric.api import run, get, local
+from fabric.state import connections
 from fabric.context_managers import settings
 from fabric.contrib.files import exists
 
 from cloudify import context
+from cloudify.exceptions import HttpException
 from cloudify.exceptions import NonRecoverableError
 
+from worker_installer.timing import OperationTimer
+from worker_installer.timing import timed
+
 
 def is_on_management_worker(ctx):
     """
@@ -37,48 +52,529 @@ def is_on_management_worker(ctx):
 def download_resource_on_host(logger, runner, url, destination_path):
     """downloads a resource from the fileserver on the agent's host
 
-    Will try to get the resource. If it fails, will try to curl.
-    If both fail, will return the state of the last fabric action.
+    The resource is downloaded with wget, or with curl if the host has no
+    wget (see download_resource_command).
     """
     logger.debug('attempting to download {0} to {1}'.format(
         url, destination_path))
-    logger.debug('checking whether wget exists on the host machine')
+    return runner.run(download_resource_command(
+        url, destination_path, getattr(runner, 'host_facts', None)))
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# seconds to wait for the file server, here and in wget on the agent's host
+DEFAULT_HTTP_TIMEOUT = 30
+
+
+def read_resource_chunks(url, chunk_size=DEFAULT_CHUNK_SIZE,
+                         timeout=DEFAULT_HTTP_TIMEOUT):
+    """reads a resource from the fileserver in fixed size chunks
+
+    The resource is never held in memory or written to disk as a whole,
+    which makes it suitable for streaming to the agent's host with
+    FabricRunner.run_with_input. A file server that does not answer
+    for ``timeout`` seconds fails the read.
+    """
+    try:
+        response = urllib2.urlopen(url, timeout=timeout)
+    except urllib2.HTTPError as e:
+        raise HttpException(e.url, e.code, e.msg)
+    try:
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        response.close()
+
+
+def _exec_command(transport, command, chunks=(), pty=False, sink=None):
+    """runs a command on a paramiko transport
+
+    Returns the exit code and the command's output. If a sink is given,
+    the command's stdout is written to it as it is read and only stderr
+    is returned as output.
+    """
+    channel = transport.open_session()
+    try:
+        if pty:
+            channel.get_pty()
+        if sink is None:
+            channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        try:
+            for chunk in chunks:
+                try:
+                    channel.sendall(chunk)
+                except socket.error:
+                    # the command exited without reading all of its
+                    # input, its exit status tells what happened
+                    break
+        finally:
+            # even if reading the chunks failed, the command would
+            # otherwise wait for more input forever
+            channel.shutdown_write()
+        if sink is None:
+            output = channel.makefile('rb').read()
+        else:
+            while True:
+                data = channel.recv(DEFAULT_CHUNK_SIZE)
+                if not data:
+                    break
+                sink.write(data)
+            output = channel.makefile_stderr('rb').read()
+        return channel.recv_exit_status(), output
+    finally:
+        channel.close()
+
+
+PUT_FILE_EXISTS_CODE = 64
+
+
+def put_command(file_path, source=None, mode=None, size=None):
+    """returns a shell command creating a file
+
+    The content is read from stdin, or from ``source`` if given, into a
+    temporary file next to ``file_path`` which is then hard linked into
+    place. Linking fails if the file exists, so an existing file is never
+    overwritten. The command exits with PUT_FILE_EXISTS_CODE if the file
+    exists.
+
+    A dropped connection looks like the end of the input to the command,
+    so the file is only linked into place if it has ``size`` bytes. No
+    size means the content is not checked, and a partially written file
+    may become visible.
+    """
+    target = pipes.quote(file_path)
+    part = pipes.quote('{0}.{1}.part'.format(file_path, uuid.uuid4().hex))
+    write = 'cat {0}> {1}'.format(
+        pipes.quote(source) + ' ' if source else '', part)
+    if size is not None:
+        write = ('{0} && {{ [ $(wc -c < {1}) -eq {2} ] || {{ echo "{1} '
+                 'is truncated, expected {2} bytes"; false; }}; }}'
+                 .format(write, part, size))
+    if mode is not None:
+        write = '{0} && chmod {1:o} {2}'.format(write, mode, part)
+    return ('test -e {0} && exit {1}; mkdir -p {2} && '
+            '{{ {3} && ln {4} {0}; }}; code=$?; rm -f {4}; '
+            '[ $code -eq 0 ] || {{ test -e {0} && exit {1}; exit $code; }}'
+            .format(target,
+                    PUT_FILE_EXISTS_CODE,
+                    pipes.quote(os.path.dirname(file_path) or '.'),
+                    write,
+                    part))
+
+
+def put_many_commands(files):
+    """returns the shell commands creating several files
+
+    ``files`` is a list of (file_path, mode, use_sudo) tuples. The first
+    command extracts a tar archive read from stdin, holding the content
+    of the n-th file as member ``n``, into a temporary directory. The
+    second creates the files from it with put_command and removes the
+    directory. It exits with PUT_FILE_EXISTS_CODE, creating nothing, if
+    any of the files exists.
+    """
+    directory = '/tmp/cloudify-put-{0}'.format(uuid.uuid4().hex)
+    extract = ('mkdir -m 700 {0} && tar xf - -C {0} || '
+               '{{ rm -rf {0}; false; }}'.format(directory))
+    steps = []
+    for index, (file_path, mode, use_sudo) in enumerate(files):
+        command = put_command(file_path,
+                              source='{0}/{1}'.format(directory, index),
+                              mode=mode)
+        steps.append(_sudo_command(command) if use_sudo
+                     else '( {0} )'.format(command))
+    install = ('if {0}; then code={1}; else {2}; code=$?; fi; '
+               'rm -rf {3}; exit $code'
+               .format(' || '.join('[ -e {0} ]'.format(pipes.quote(f[0]))
+                                   for f in files),
+                       PUT_FILE_EXISTS_CODE,
+                       ' && '.join(steps),
+                       directory))
+    return extract, install
+
+
+def _copy_readable_file(file_path, sink):
+    """copies a local file into a sink unless it cannot be opened"""
     try:
-        runner.run('which wget')
-    except FabricRunnerException:
-        pass
-    else:
-        logger.debug('wget-ing {0} to {1}'.format(url, destination_path))
-        return runner.run('wget -T 30 {0} -O {1}'.format(
-            url, destination_path))
-    logger.debug('checking whether curl exists on the host machine')
+        f = open(file_path, 'rb')
+    except IOError:
+        return False
+    with f:
+        for chunk in iter(lambda: f.read(DEFAULT_CHUNK_SIZE), ''):
+            sink.write(chunk)
+    return True
+
+
+def _sudo_command(command):
+    return 'sudo sh -c {0}'.format(pipes.quote(command))
+
+
+def _content_size(content):
+    """returns the size of a string or of a seekable file object's
+    remaining content, None if it cannot be told"""
+    if not hasattr(content, 'read'):
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        return len(content)
     try:
-        runner.run('which curl')
-    except FabricRunnerException:
-        pass
-    else:
-        logger.debug('curl-ing {0} to {1}'.format(url, destination_path))
-        return runner.run('curl {0} -o {1}'.format(
-            url, destination_path))
-    raise NonRecoverableError(
-        'could not download resource ({0}), wget and curl not found'.format(
-            url))
+        position = content.tell()
+        content.seek(0, os.SEEK_END)
+        size = content.tell() - position
+        content.seek(position)
+    except (AttributeError, IOError, OSError):
+        return None
+    return size
+
+
+def _content_chunks(content, chunk_size=DEFAULT_CHUNK_SIZE):
+    if hasattr(content, 'read'):
+        return iter(lambda: content.read(chunk_size), '')
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return [content]
+
+
+def _tar_archive(contents):
+    archive = StringIO()
+    tar = tarfile.open(fileobj=archive, mode='w')
+    for index, content in enumerate(contents):
+        data = ''.join(_content_chunks(content))
+        info = tarfile.TarInfo(str(index))
+        info.size = len(data)
+        tar.addfile(info, StringIO(data))
+    tar.close()
+    archive.seek(0)
+    return archive
+
+
+def _create_file(file_path, chunks):
+    """creates a local file, the same way put_command does"""
+    directory = os.path.dirname(file_path) or '.'
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, part = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        os.fchmod(fd, 0644)
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.link(part, file_path)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            raise NonRecoverableError('Cannot put file, file already '
+                                      'exists: {0}'.format(file_path))
+        raise
+    finally:
+        os.remove(part)
+
+
+DEFAULT_CONNECTION_IDLE_TIMEOUT = 300
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+DEFAULT_HEALTH_CHECK_TIMEOUT = 5
+
+
+class ConnectionPool(object):
+    """
+    Keeps fabric ssh connections open across operations.
+
+    Connections live in fabric's own connection cache (which is keyed by
+    host string), this class only decides when a cached connection may be
+    reused. A connection is dropped before reuse if it was opened with
+    different credentials, has been idle for longer than ``idle_timeout``
+    seconds or the server does not answer on it within
+    ``health_check_timeout`` seconds when a new operation starts. At most
+    ``max_connections_per_host`` connections are kept for a single host,
+    the least recently used one is evicted first.
+    """
+
+    def __init__(self,
+                 idle_timeout=DEFAULT_CONNECTION_IDLE_TIMEOUT,
+                 max_connections_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                 health_check_timeout=DEFAULT_HEALTH_CHECK_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.max_connections_per_host = max_connections_per_host
+        self.health_check_timeout = health_check_timeout
+        self._lock = threading.RLock()
+        # host string -> (credentials, last used timestamp, in use)
+        self._entries = {}
+
+    def acquire(self, host_string, key_filename=None, password=None):
+        """
+        Prepares the cache for a connection to ``host_string``.
+
+        The connection itself is opened lazily by fabric on first use.
+        """
+        credentials = (key_filename, password)
+        with self._lock:
+            entry = self._entries.get(host_string)
+            if entry is not None:
+                # the server is asked once when an operation starts to reuse
+                # the connection, not again for each of its commands
+                if entry[0] != credentials or \
+                        self._is_idle(entry) or \
+                        not (entry[2] or self._is_healthy(host_string)):
+                    self.evict(host_string)
+            if host_string not in self._entries:
+                self._enforce_host_limit(host_string)
+            self._entries[host_string] = (credentials, time.time(), True)
+
+    def release(self, host_string):
+        with self._lock:
+            entry = self._entries.get(host_string)
+            if entry is not None:
+                self._entries[host_string] = (entry[0], time.time(), False)
+            self.evict_idle()
+
+    def evict(self, host_string):
+        with self._lock:
+            self._entries.pop(host_string, None)
+            if host_string in connections:
+                try:
+                    connections[host_string].close()
+                except Exception:
+                    pass
+                del connections[host_string]
+
+    def evict_idle(self):
+        with self._lock:
+            for host_string, entry in self._entries.items():
+                if self._is_idle(entry):
+                    self.evict(host_string)
+
+    def reset(self):
+        """
+        Forgets all connections without closing them.
+
+        Used in forked processes, where the sockets are still owned by
+        the parent process.
+        """
+        # the lock may have been held by another thread while forking
+        self._lock = threading.RLock()
+        self._entries = {}
+        connections.clear()
+
+    def evict_all(self):
+        with self._lock:
+            for host_string in self._entries.keys():
+                self.evict(host_string)
+
+    def _is_idle(self, entry):
+        return time.time() - entry[1] > self.idle_timeout
+
+    def _is_healthy(self, host_string):
+        if host_string not in connections:
+            # not connected yet, fabric will connect on first use
+            return True
+        transport = connections[host_string].get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        # a write succeeds on a half dead connection as well, only an answer
+        # from the server tells that it is still there. paramiko cannot
+        # open a session with a timeout, so it is waited for here.
+        sessions = []
+
+        def open_session():
+            try:
+                sessions.append(transport.open_session())
+            except Exception:
+                pass
+        thread = threading.Thread(target=open_session)
+        thread.daemon = True
+        thread.start()
+        thread.join(self.health_check_timeout)
+        if not sessions:
+            # an unanswered attempt ends once the connection is evicted
+            return False
+        sessions[0].close()
+        return True
+
+    def _enforce_host_limit(self, host_string):
+        host = _host_of(host_string)
+        same_host = sorted(
+            (entry[1], key) for key, entry in self._entries.items()
+            if _host_of(key) == host)
+        while len(same_host) >= self.max_connections_per_host:
+            _, oldest = same_host.pop(0)
+            self.evict(oldest)
+
+
+def _host_of(host_string):
+    return host_string.split('@')[-1].rsplit(':', 1)[0]
+
+
+connection_pool = ConnectionPool()
+
+
+def download_resource_command(url, destination_path, host_facts=None):
+    """returns a shell command which downloads a resource on the agent's host
+
+    The resource is downloaded with wget, or with curl if the host has no
+    wget. Given the host's facts, the command uses the right tool right
+    away, otherwise it looks for them on the host. The command is meant
+    to be used as part of a command batch.
+    """
+    host_facts = host_facts or {}
+    if host_facts.get('wget'):
+        return 'wget -T {2} {0} -O {1}'.format(url, destination_path,
+                                               DEFAULT_HTTP_TIMEOUT)
+    if host_facts.get('curl'):
+        return 'curl {0} -o {1}'.format(url, destination_path)
+    if 'wget' in host_facts and 'curl' in host_facts:
+        raise NonRecoverableError(
+            'could not download resource ({0}), wget and curl not found'
+            .format(url))
+    return ('if which wget > /dev/null 2>&1; then '
+            'wget -T {2} {0} -O {1}; '
+            'elif which curl > /dev/null 2>&1; then '
+            'curl {0} -o {1}; '
+            'else echo "could not download resource ({0}), '
+            'wget and curl not found"; false; fi'
+            .format(url, destination_path, DEFAULT_HTTP_TIMEOUT))
+
+
+class BatchCommand(object):
+    """
+    A single step of a command batch (see FabricRunner.run_batch).
+
+    After the batch runs, ``code`` and ``output`` hold the step's exit
+    code and combined stdout/stderr and ``duration`` the seconds it took
+    on the host, if the host's date command can tell. They remain None
+    for steps which did not run because an earlier step failed. The
+    duration of a step given a ``phase`` is added to that phase of the
+    runner's timer.
+
+    A step may also be given a ``native`` callable doing the same as its
+    command, with which a local runner performs the step in-process
+    rather than in a shell. It returns the step's output, if any, and
+    raises OSError or IOError if the step fails.
+    """
+
+    def __init__(self, command, ignore_errors=False, phase=None,
+                 native=None):
+        self.command = command
+        self.ignore_errors = ignore_errors
+        self.phase = phase
+        self.native = native
+        self.code = None
+        self.output = None
+        self.duration = None
+
+    @property
+    def failed(self):
+        return self.code is not None and self.code != 0
+
+
+def mkdir_command(path):
+    """returns a BatchCommand creating a directory and its parents"""
+    return BatchCommand('mkdir -p {0}'.format(path),
+                        native=lambda: _make_dirs(path))
+
+
+def touch_command(path):
+    """returns a BatchCommand creating an empty file or updating its
+    times"""
+    return BatchCommand('touch {0}'.format(path),
+                        native=lambda: _touch(path))
+
+
+def remove_command(path, phase=None):
+    """returns a BatchCommand removing a file unless it is missing"""
+    return BatchCommand('rm -f {0}'.format(path), phase=phase,
+                        native=lambda: _remove(path))
+
+
+def symlink_command(link_path, target, ignore_errors=False, phase=None):
+    """returns a BatchCommand replacing a symbolic link"""
+    return BatchCommand('unlink {0} && ln -s {1} {0}'.format(link_path,
+                                                             target),
+                        ignore_errors=ignore_errors, phase=phase,
+                        native=lambda: _relink(link_path, target))
+
+
+def _make_dirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def _touch(path):
+    with open(path, 'a'):
+        os.utime(path, None)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _relink(link_path, target):
+    os.unlink(link_path)
+    os.symlink(target, link_path)
+
+
+BATCH_STEP_OPEN = '###CLOUDIFYBATCHOPEN'
+BATCH_STEP_CLOSE = 'CLOUDIFYBATCHCLOSE###'
+
+
+def _batch_step_duration(timestamps):
+    # nanosecond timestamps, date prints something else where %N is not
+    # supported
+    try:
+        started, ended = [int(t) for t in timestamps]
+    except ValueError:
+        return None
+    return (ended - started) / 1e9
 
 
 class FabricRunner(object):
 
-    def __init__(self, ctx, agent_config=None):
+    def __init__(self, ctx, agent_config=None, local=None):
         self.ctx = ctx
         config = agent_config or {}
-        self.local = is_on_management_worker(ctx)
+        if local is None:
+            local = is_on_management_worker(ctx)
+        self.local = local
         if not self.local:
             self.host_string = '%(user)s@%(host)s:%(port)s' % config
             self.key_filename = config.get('key')
             self.password = config.get('password')
 
+    @property
+    def timer(self):
+        """the timing spans of the operation the runner is used for"""
+        if getattr(self, '_timer', None) is None:
+            self._timer = OperationTimer()
+        return self._timer
+
+    @contextmanager
+    def _settings(self):
+        connection_pool.acquire(self.host_string,
+                                self.key_filename,
+                                self.password)
+        with settings(host_string=self.host_string,
+                      key_filename=self.key_filename,
+                      password=self.password,
+                      disable_known_hosts=True):
+            if self.host_string not in connections:
+                with self.timer.phase('connect'):
+                    connections.connect(self.host_string)
+            yield
+
     def ping(self):
         self.run('echo "ping!"')
 
+    @timed
     def run(self, command, shell_escape=None):
         self.ctx.logger.debug('Running command: {0}'.format(command))
         if self.local:
@@ -93,77 +589,365 @@ class FabricRunner(object):
             except Exception as e:
                 raise FabricRunnerException(command, -1, str(e))
         out = StringIO()
-        with settings(host_string=self.host_string,
-                      key_filename=self.key_filename,
-                      password=self.password,
-                      disable_known_hosts=True):
+        with self._settings():
             try:
                 return run(command, stdout=out, stderr=out,
                            shell_escape=shell_escape)
             except SystemExit, e:
                 raise FabricRunnerException(command, e.code, out.getvalue())
 
+    @timed
+    def run_batch(self, commands):
+        """
+        Runs a list of BatchCommand objects in a single remote session.
+
+        The commands are joined into one shell script, their output is
+        separated by delimiters and parsed back into the given commands.
+        Execution stops at the first failing command which was not created
+        with ignore_errors=True, and a FabricRunnerException is raised for
+        it.
+
+        Locally, commands having a native implementation are performed
+        in-process and only the others are run in a shell, consecutive
+        ones in the same shell.
+        """
+        if not self.local:
+            return self._run_shell_batch(commands)
+        pending = []
+        for command in commands:
+            if command.native is None:
+                pending.append(command)
+                continue
+            if pending:
+                self._run_shell_batch(pending)
+                pending = []
+            self._run_native(command)
+        if pending:
+            self._run_shell_batch(pending)
+        return commands
+
+    def _run_native(self, command):
+        self.ctx.logger.debug('Running command: {0}'.format(command.command))
+        started = time.time()
+        try:
+            command.output = command.native() or ''
+            command.code = 0
+        except (OSError, IOError) as e:
+            command.output = str(e)
+            command.code = 1
+        command.duration = time.time() - started
+        if command.phase:
+            self.timer.add_phase(command.phase, command.duration)
+        if command.failed and not command.ignore_errors:
+            raise FabricRunnerException(command.command,
+                                        command.code,
+                                        command.output)
+
+    def _run_shell_batch(self, commands):
+        script = []
+        for index, command in enumerate(commands):
+            script.append("echo '{0}{1}'; started=$(date +%s%N)".format(
+                BATCH_STEP_OPEN, index))
+            script.append('( {0} ) 2>&1'.format(command.command))
+            script.append('rc=$?; echo "{0}{1} $rc $started $(date +%s%N)"'
+                          .format(BATCH_STEP_CLOSE, index))
+            if not command.ignore_errors:
+                script.append('if [ $rc -ne 0 ]; then exit 0; fi')
+        stdout = self.run('\n'.join(script))
+
+        for index, command in enumerate(commands):
+            open_delim = '{0}{1}'.format(BATCH_STEP_OPEN, index)
+            close_delim = '{0}{1} '.format(BATCH_STEP_CLOSE, index)
+            start = stdout.find(open_delim)
+            end = stdout.find(close_delim)
+            if start == -1 or end == -1:
+                break
+            command.output = stdout[start + len(open_delim):end].strip()
+            status = stdout[end + len(close_delim):].split(None, 3)
+            command.code = int(status[0])
+            command.duration = _batch_step_duration(status[1:3])
+            if command.phase and command.duration is not None:
+                self.timer.add_phase(command.phase, command.duration)
+            if command.failed and not command.ignore_errors:
+                raise FabricRunnerException(command.command,
+                                            command.code,
+                                            command.output)
+        return commands
+
+    @timed
+    def run_with_input(self, command, chunks):
+        """
+        Runs a command, writing the given chunks to its stdin as they come.
+
+        Returns the command's output, which is not meant to be large as it
+        is only read once all input has been written.
+        """
+        self.ctx.logger.debug(
+            'Running command with streamed input: {0}'.format(command))
+        if self.local:
+            process = subprocess.Popen(command, shell=True,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            try:
+                for chunk in chunks:
+                    try:
+                        process.stdin.write(chunk)
+                    except IOError as e:
+                        # the command may exit without reading all of
+                        # its input
+                        if e.errno != errno.EPIPE:
+                            raise
+                        break
+            finally:
+                try:
+                    process.stdin.close()
+                except IOError:
+                    pass
+            output = process.stdout.read()
+            code = process.wait()
+        else:
+            with self._settings():
+                client = connections[self.host_string]
+            code, output = _exec_command(client.get_transport(),
+                                         command, chunks)
+        output = output.strip()
+        if code != 0:
+            raise FabricRunnerException(command, code, output)
+        return output
+
+    @timed
     def exists(self, file_path):
         if self.local:
             return os.path.exists(file_path)
-        with settings(host_string=self.host_string,
-                      key_filename=self.key_filename,
-                      password=self.password,
-                      disable_known_hosts=True):
+        with self._settings():
             return exists(file_path)
 
+    @timed
     def put(self, file_path, content, use_sudo=False):
+        """
+        Creates a file with the given content, a string or a file object.
+
+        The content is streamed to a single command which refuses to
+        overwrite an existing file, and which only creates the file once
+        all of the content arrived if its size can be told (see
+        put_command). Sudo cannot be given stdin on hosts which may
+        require a tty for it, there the content is first streamed to a
+        temporary file which a second command moves into place.
+        """
         self.ctx.logger.debug(
             'Putting file: {0} [use_sudo={1}]'.format(file_path, use_sudo))
-        directory = "/".join(file_path.split("/")[:-1])
-        if self.local:
-            if os.path.exists(file_path):
+        size = _content_size(content)
+        chunks = _content_chunks(content)
+        if self.local and not use_sudo:
+            # no sudo needed. just use python for this
+            _create_file(file_path, chunks)
+            return
+        try:
+            if use_sudo and not self.local and self._may_require_tty():
+                part = self.run_with_input(
+                    'part=$(mktemp) && cat > "$part" && echo "$part"',
+                    chunks)
+                self.run_batch([BatchCommand(
+                    '{0}; code=$?; rm -f {1}; exit $code'.format(
+                        _sudo_command(put_command(file_path, source=part,
+                                                  size=size)),
+                        pipes.quote(part)))])
+            else:
+                command = put_command(file_path, size=size)
+                if use_sudo:
+                    command = _sudo_command(command)
+                self.run_with_input(command, chunks)
+        except FabricRunnerException as e:
+            if e.code == PUT_FILE_EXISTS_CODE:
                 raise NonRecoverableError('Cannot put file, file already '
                                           'exists: {0}'.format(file_path))
-            if use_sudo:
-                # we need to write a string to a file locally with sudo
-                # use echo for now
-                if not os.path.exists(directory):
-                    self.run("sudo mkdir -p {0}".format(directory))
-                temp_file = tempfile.mktemp()
-                with open(temp_file, 'w') as f:
-                    f.write(content)
-                self.run('sudo cp {0} {1}'.format(temp_file, file_path))
-                self.run('sudo rm {0}'.format(temp_file))
+            raise
+
+    @timed
+    def put_many(self, files):
+        """
+        Creates several files in a single transfer.
+
+        files is a list of (file_path, content, mode, use_sudo) tuples,
+        content being a string or a file object and mode an int or None.
+        The contents are sent as one tar archive and the files created
+        from it in one command (see put_many_commands), unless sudo may
+        require a tty, in which case the files are created by a second
+        command. No file is created if any of them already exists.
+        """
+        self.ctx.logger.debug('Putting files: {0}'.format(
+            ', '.join('{0} [use_sudo={1}]'.format(f[0], f[3])
+                      for f in files)))
+        archive = _tar_archive(f[1] for f in files)
+        extract, install = put_many_commands(
+            [(f[0], f[2], f[3]) for f in files])
+        chunks = _content_chunks(archive)
+        try:
+            if any(f[3] for f in files) and not self.local and \
+                    self._may_require_tty():
+                self.run_with_input(extract, chunks)
+                self.run_batch([BatchCommand(install)])
             else:
-                # no sudo needed. just use python for this
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-                with open(file_path, 'w') as f:
-                    f.write(content)
-        else:
-            with settings(host_string=self.host_string,
-                          key_filename=self.key_filename,
-                          password=self.password,
-                          disable_known_hosts=True):
-                if exists(file_path):
-                    raise NonRecoverableError('Cannot put file, file already '
-                                              'exists: {0}'.format(file_path))
-                mkdir_command = 'mkdir -p {0}'.format(directory)
-                sudo(mkdir_command) if use_sudo else run(mkdir_command)
-                put(StringIO(content), file_path, use_sudo=use_sudo)
-
-    def get(self, file_path):
+                self.run_with_input('{0} && {{ {1}; }}'.format(
+                    extract, install), chunks)
+        except FabricRunnerException as e:
+            if e.code == PUT_FILE_EXISTS_CODE:
+                raise NonRecoverableError(
+                    'Cannot put files, one of the files already exists: '
+                    '{0}'.format(', '.join(f[0] for f in files)))
+            raise
+
+    def _may_require_tty(self):
+        facts = getattr(self, 'host_facts', None)
+        return facts is None or facts.get('requiretty', True)
+
+    @timed
+    def get(self, file_path, sink=None):
+        """
+        Reads a file from the host.
+
+        If a sink (a file object) is given, the content is written to it
+        as it is read and the sink is returned. Otherwise the content is
+        returned as a string. Locally, the file is read with sudo only if
+        it cannot be read otherwise.
+        """
+        output = StringIO() if sink is None else sink
+        if self.local and _copy_readable_file(file_path, output):
+            return output.getvalue() if sink is None else sink
         if self.local:
-            return self.run('sudo cat {0}'.format(file_path))
+            command = 'sudo cat {0}'.format(file_path)
+            process = subprocess.Popen(command, shell=True,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            for chunk in iter(lambda: process.stdout.read(
+                    DEFAULT_CHUNK_SIZE), ''):
+                output.write(chunk)
+            error = process.stderr.read()
+            code = process.wait()
+            if code != 0:
+                raise FabricRunnerException(command, code, error.strip())
         else:
-            output = StringIO()
-            with settings(host_string=self.host_string,
-                          key_filename=self.key_filename,
-                          password=self.password,
-                          disable_known_hosts=True):
+            with self._settings():
                 get(file_path, output)
-                return output.getvalue()
+        return output.getvalue() if sink is None else sink
 
     def close(self):
         if self.local:
             return
-        fabric.network.disconnect_all()
+        connection_pool.release(self.host_string)
+
+
+class ParamikoRunner(FabricRunner):
+    """
+    A runner which talks to the host with its own paramiko client.
+
+    Unlike FabricRunner it does not use fabric's global env or connection
+    cache, so separate instances can be used concurrently from multiple
+    threads of the same process. Local execution is inherited from
+    FabricRunner.
+
+    It does not answer sudo password prompts the way fabric does, so the
+    agent's user needs passwordless sudo on the host.
+    """
+
+    def __init__(self, ctx, agent_config=None, local=None):
+        super(ParamikoRunner, self).__init__(ctx, agent_config, local)
+        if not self.local:
+            config = agent_config or {}
+            self.user = config['user']
+            self.host = config['host']
+            self.port = int(config['port'])
+        self._ssh = None
+        self._lock = threading.Lock()
+
+    def _client(self):
+        with self._lock:
+            if self._ssh is None:
+                ssh = paramiko.SSHClient()
+                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                key_filename = self.key_filename
+                if key_filename:
+                    key_filename = os.path.expanduser(key_filename)
+                with self.timer.phase('connect'):
+                    ssh.connect(self.host,
+                                port=self.port,
+                                username=self.user,
+                                password=self.password,
+                                key_filename=key_filename)
+                self._ssh = ssh
+            return self._ssh
+
+    def _execute(self, command, pty=True):
+        return _exec_command(self._client().get_transport(), command,
+                             pty=pty)
+
+    @timed
+    def run(self, command, shell_escape=None):
+        if self.local:
+            return super(ParamikoRunner, self).run(command, shell_escape)
+        self.ctx.logger.debug('Running command: {0}'.format(command))
+        code, output = self._execute(command)
+        output = output.replace('\r\n', '\n').strip()
+        if code != 0:
+            raise FabricRunnerException(command, code, output)
+        return output
+
+    @timed
+    def run_with_input(self, command, chunks):
+        if self.local:
+            return super(ParamikoRunner, self).run_with_input(command, chunks)
+        self.ctx.logger.debug(
+            'Running command with streamed input: {0}'.format(command))
+        code, output = _exec_command(self._client().get_transport(),
+                                     command, chunks)
+        output = output.strip()
+        if code != 0:
+            raise FabricRunnerException(command, code, output)
+        return output
+
+    @timed
+    def exists(self, file_path):
+        if self.local:
+            return super(ParamikoRunner, self).exists(file_path)
+        code, _ = self._execute('test -e "$(echo {0})"'.format(file_path))
+        return code == 0
+
+    @timed
+    def get(self, file_path, sink=None):
+        if self.local:
+            return super(ParamikoRunner, self).get(file_path, sink)
+        output = StringIO() if sink is None else sink
+        command = 'cat {0}'.format(pipes.quote(file_path))
+        code, error = _exec_command(self._client().get_transport(),
+                                    command, sink=output)
+        if code != 0:
+            raise FabricRunnerException(command, code, error.strip())
+        return output.getvalue() if sink is None else sink
+
+    def close(self):
+        with self._lock:
+            if self._ssh is not None:
+                self._ssh.close()
+                self._ssh = None
+
+
+RUNNERS = {
+    'fabric': FabricRunner,
+    'paramiko': ParamikoRunner
+}
+
+
+def create_runner(ctx, agent_config=None, local=None):
+    """creates the runner selected by the agent's 'runner' setting"""
+
+    config = agent_config or {}
+    name = config.get('runner') or 'fabric'
+    if name not in RUNNERS:
+        raise NonRecoverableError(
+            'Unknown runner: {0}, expected one of {1}'.format(
+                name, sorted(RUNNERS.keys())))
+    return RUNNERS[name](ctx, agent_config, local=local)
 
 
 class FabricRunnerException(Exception):